@@ -2,66 +2,331 @@
 # Adding type to arguments and return value will help the system show the types properly
 # Please update the function name/signature per need
 import os
-import pandas as pd
-from utils.helper import run, run_get_products
+import asyncio
+from contextlib import asynccontextmanager
+from utils.helper import run_async, run_get_products_async, run_batch_async, export_orders, preload_products, product_catalog, invalidate_orders, order_refresher, order_json_etag, tree_options, ORDER_TREE_SOURCE, async_order_flight, async_product_flight, order_cache, product_cache, admission
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 import uvicorn
-from typing import List
-from utils.custom_types import OrderNumber, ProductRequest, Product
-from utils.connections import sf_engine
-from sqlalchemy import text
-from utils.email_generator import generate_order_email
-from fastapi import Path
+from datetime import date
+from typing import Dict, List, Optional
+from utils.custom_types import OrderNumber, ProductRequest, Product, BatchOrderRequest, BatchOrderResult, BatchEmailResult
+from utils.connections import sf_engine, engine_manager
+from utils.health import ReadinessProbe
+from utils.invalidation import ChangeWatcher, CHANGE_DETECTION, WATCHED_TABLES
+from utils.replica import Replica, DATA_SOURCE, REPLICA_URL
+from utils.admission import Overloaded, RateLimiter, parse_rate_limits, lane_for_path, current_lane, admission_rejections_total, API_KEY_HEADER, RATE_LIMITS
+from utils.queries import QueryHistoryCollector
+from utils.email_generator import generate_order_email, email_cache
+from fastapi import Path, Query, Request
+from utils import metrics
+from utils.serialization import content_etag, dump_orders, dump_products, etag_matches
+import json
+import logging
+import math
+import time
+
+# per-request messages such as cache hits are logged at DEBUG
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# Cache-Control sent with order and product responses. Orders carry contact
+# details so shared caches may not keep them, and clients revalidate with the
+# ETag every time, which costs a cache lookup and no serialisation
+ORDER_CACHE_CONTROL = os.getenv('ORDER_CACHE_CONTROL', 'private, no-cache')
+PRODUCT_CACHE_CONTROL = os.getenv('PRODUCT_CACHE_CONTROL', 'private, max-age=3600')
+
+readiness_probe = ReadinessProbe(sf_engine)
+query_history = QueryHistoryCollector(sf_engine)
+
+# orders and products are looked up through data_engine, the local replica
+# once it has been synced when DATA_SOURCE=replica
+replica = Replica(REPLICA_URL, sf_engine) if DATA_SOURCE == 'replica' else None
+data_engine = replica.engine_or(sf_engine) if replica is not None else sf_engine
+if replica is not None and ORDER_TREE_SOURCE == 'materialized':
+    # the replica holds no copy of the materialised tree table
+    raise ValueError("ORDER_TREE_SOURCE=materialized can't be used with DATA_SOURCE=replica")
+
+def invalidate_changed(changed):
+    # materialised rows built before these changes are not served any more
+    invalidate_orders(changed, changed_at=change_watcher.watermark())
+
+# changes are read where the orders are, with the replica an order is dropped
+# once its new rows have been synced instead of being read again from the
+# copy that still has the old ones. Every worker polls its own replica copy
+change_watcher = ChangeWatcher(data_engine, invalidate_changed) if CHANGE_DETECTION else None
+
+rate_limiter = RateLimiter(overrides=parse_rate_limits(RATE_LIMITS))
+
+def freshness_headers(tables) -> dict:
+    # how far behind Snowflake the replica's answer may be
+    if replica is None or not replica.ready():
+        return {}
+    return {"X-Data-Freshness": replica.freshness(tables)}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # log in to Snowflake before the first request instead of during it
+    try:
+        await asyncio.to_thread(engine_manager.warm_up)
+    except Exception as e:
+        logger.warning(f"Snowflake warm-up failed: {e}")
+    try:
+        await asyncio.to_thread(preload_products)
+    except Exception as e:
+        logger.warning(f"Product preload failed: {e}")
+    if product_catalog is not None:
+        product_catalog.start()
+    if change_watcher is not None:
+        change_watcher.start()
+    if replica is not None:
+        replica.start()
+    readiness_probe.start()
+    query_history.start()
+    yield
+    query_history.stop()
+    readiness_probe.stop()
+    if replica is not None:
+        replica.stop()
+    if change_watcher is not None:
+        change_watcher.stop()
+    if product_catalog is not None:
+        product_catalog.stop()
+    order_refresher.shutdown()
+    engine_manager.dispose()
 
 app = FastAPI(
     title="Wismo Order API",
     description="API for retrieving order information",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+@app.middleware("http")
+async def admit_request(request: Request, call_next):
+    # health checks and scrapes are never limited
+    path = request.url.path
+    if path.startswith("/health") or path == "/metrics":
+        return await call_next(request)
+
+    lane = lane_for_path(path)
+    client = rate_limiter.client(request.headers.get(API_KEY_HEADER), request.client.host if request.client else "unknown")
+    wait = rate_limiter.take(client)
+    if wait:
+        admission_rejections_total.inc(reason="rate_limit", lane=lane)
+        return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"}, headers={"Retry-After": str(math.ceil(wait))})
+
+    # the helpers queue this request's queries in its lane
+    token = current_lane.set(lane)
+    try:
+        return await call_next(request)
+    finally:
+        current_lane.reset(token)
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(status_code=exc.status, content={"detail": str(exc)}, headers={"Retry-After": str(math.ceil(exc.retry_after))})
+
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    # stage timings, query counts and cache results of the request are
+    # collected in a context variable by the helpers
+    stats, token = metrics.start_request()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        if metrics.SERVER_TIMING:
+            response.headers["Server-Timing"] = stats.server_timing(time.perf_counter() - start)
+        return response
+    finally:
+        # label by the route template so order numbers don't become labels
+        route = request.scope.get("route")
+        metrics.end_request(token, stats, route.path if route else "unmatched", status, time.perf_counter() - start)
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Wismo API. Use /order_number to get email data."}
 
+def service_stats() -> dict:
+    return {
+        "pool": engine_manager.stats(),
+        "order_cache": order_cache.stats(),
+        "order_refresh": order_refresher.stats(),
+        "product_cache": product_cache.stats(),
+        "email_cache": email_cache.stats(),
+        "change_detection": change_watcher.stats() if change_watcher is not None else None,
+        "product_catalog": product_catalog.stats() if product_catalog is not None else None,
+        "replica": replica.stats() if replica is not None else None,
+        "admission": admission.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "queries": query_history.stats(),
+        "order_fetches": async_order_flight.stats(),
+        "product_fetches": async_product_flight.stats()
+    }
+
+@app.get("/health/live")
+def liveness_check():
+    # the process is up and serving, never touches Snowflake
+    return {"status": "alive", **service_stats()}
+
+@app.get("/health/ready")
 @app.get("/health")
-def health_check():
+def readiness_check():
+    # last result of the background probe, never touches Snowflake
+    probe = readiness_probe.result()
+    body = {"status": "healthy" if probe["ready"] else "unhealthy", **probe, **service_stats()}
+    return JSONResponse(status_code=200 if probe["ready"] else 503, content=body)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    metrics.cache_entries.set(order_cache.stats().get("total_entries", 0), cache="order")
+    metrics.cache_entries.set(product_cache.stats()["total_entries"], cache="product")
+    metrics.cache_entries.set(email_cache.stats()["total_entries"], cache="email")
+    metrics.pool_checked_out.set(engine_manager.stats().get("pool_checkedout", 0))
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/orders/batch", response_model=Dict[str, BatchOrderResult])
+async def get_orders_batch(request: BatchOrderRequest):
     try:
-        # Test database connection
-        engine = sf_engine()
-        with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
-        return {"status": "healthy", "database": "connected"}
+        results = await run_batch_async(request.orderNumbers, data_engine)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Overloaded:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=503, detail=f"Service unhealthy: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # written out directly instead of validating every tree against response_model again
+    entries = []
+    for order_number, result in results.items():
+        if "orders" in result:
+            value = b'{"orders":%s,"error":null}' % dump_orders(result["orders"])
+        else:
+            value = json.dumps({"orders": None, "error": result["error"]}, separators=(",", ":")).encode()
+        entries.append(json.dumps(order_number).encode() + b":" + value)
+    return Response(b"{" + b",".join(entries) + b"}", media_type="application/json", headers=freshness_headers(WATCHED_TABLES))
+
+@app.get("/orders/export")
+async def export_order_status(
+    shipTo: Optional[int] = Query(None, description="only orders shipped to this customer"),
+    bookedFrom: Optional[date] = Query(None, description="only orders booked on or after this date"),
+    bookedTo: Optional[date] = Query(None, description="only orders booked on or before this date")
+):
+    if shipTo is None and bookedFrom is None and bookedTo is None:
+        raise HTTPException(status_code=400, detail="Provide shipTo or a bookedFrom/bookedTo date range")
+
+    # one JSON document per root order, streamed as the pages are resolved.
+    # The first page is resolved before answering, an export that isn't
+    # admitted is turned away with a 503 like any other request
+    lines = export_orders(ship_to=shipTo, booked_from=bookedFrom, booked_to=bookedTo, sf_engine=data_engine)
+    try:
+        first = await anext(lines, b"")
+    except Overloaded:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def body():
+        yield first
+        async for line in lines:
+            yield line
+
+    return StreamingResponse(
+        body(),
+        media_type="application/x-ndjson",
+        headers=freshness_headers(WATCHED_TABLES)
+    )
 
 @app.get("/{order_number}", response_model=List[OrderNumber])
-def get_order(order_number: str = Path(...,example='533212')):
+async def get_order(
+    request: Request,
+    order_number: str = Path(...,example='533212'),
+    maxDepth: Optional[int] = Query(None, ge=0, description="levels of split orders to resolve, every level when left out"),
+    skus: bool = Query(True, description="include the skus of each order"),
+    cartons: bool = Query(True, description="include the cartons of each order"),
+    splitOrders: bool = Query(True, description="include the split orders, same as maxDepth=0 when false")
+):
+    # the parts left out are not queried at all
+    options = tree_options(maxDepth, skus, cartons, splitOrders)
     try:
-        result = run(order_number)
-        return result
+        cached = await run_async(order_number, data_engine, options=options)
+        # the trees are serialised straight to bytes, FastAPI would validate them
+        # again, and not at all when the client already has this version
+        data, etag = order_json_etag(cached, request.headers.get("If-None-Match"))
+        headers = {"ETag": etag, "Cache-Control": ORDER_CACHE_CONTROL, **freshness_headers(WATCHED_TABLES)}
+        if data is None:
+            return Response(status_code=304, headers=headers)
+        return Response(data, media_type="application/json", headers=headers)
+    except Overloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/email/{order_number}")
-def get_email(order_number: str = Path(...,example='533212')):
+async def get_email(
+    order_number: str = Path(...,example='533212'),
+    format: str = Query("text", pattern="^(text|html)$", description="text or html")
+):
     try:
-        results = run(order_number)
+        cached = await run_async(order_number, data_engine)
+        results = cached.orders
         if not results:
             raise HTTPException(status_code=404, detail="Order not found")
         
         # Since the API returns a list, we'll generate an email for the first order
         # You might want to adjust this logic based on your needs
         main_order = results[0]
-        return generate_order_email(main_order)
+        return generate_order_email(main_order, format, version=cached.etag)
 
+    except (HTTPException, Overloaded):
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/email/batch", response_model=Dict[str, BatchEmailResult])
+async def get_emails_batch(
+    request: BatchOrderRequest,
+    format: str = Query("text", pattern="^(text|html)$", description="text or html")
+):
+    # resolves the orders like /orders/batch and renders the main order of each,
+    # unchanged orders are served from the email cache
+    try:
+        lookups = await run_batch_async(request.orderNumbers, data_engine)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except Overloaded:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    emails = {}
+    for order_number, lookup in lookups.items():
+        if lookup.get("error"):
+            emails[order_number] = {"error": lookup["error"]}
+        elif not lookup["orders"]:
+            emails[order_number] = {"error": "Order not found"}
+        else:
+            try:
+                emails[order_number] = {"email": generate_order_email(lookup["orders"][0], format, version=lookup["etag"])}
+            except Exception as e:
+                emails[order_number] = {"error": str(e)}
+    return emails
+
 @app.post("/products/", response_model=List[Product])    
-def get_products(request: ProductRequest):
+async def get_products(request: ProductRequest, http_request: Request):
     try:
-        return run_get_products(request.skus)
-    
+        products = await run_get_products_async(request.skus, data_engine)
+        data = dump_products(products)
+        etag = content_etag(data)
+        headers = {"ETag": etag, "Cache-Control": PRODUCT_CACHE_CONTROL, **freshness_headers(["wismo_products"])}
+        if etag_matches(http_request.headers.get("If-None-Match"), etag):
+            return Response(status_code=304, headers=headers)
+        return Response(data, media_type="application/json", headers=headers)
+    except Overloaded:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
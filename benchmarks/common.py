@@ -0,0 +1,32 @@
+import statistics
+import time
+from typing import Callable, List
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """The q-th percentile (0-100) of samples, nearest rank."""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(fn: Callable[[], object], repeat: int = 50, warmup: int = 3) -> List[float]:
+    """Seconds taken by each of repeat calls of fn, after warmup untimed calls."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name: str, samples: List[float], extra: str = "") -> None:
+    print(
+        f"{name:<40} n={len(samples):<5} "
+        f"mean={statistics.fmean(samples) * 1000:9.3f}ms "
+        f"p50={percentile(samples, 50) * 1000:9.3f}ms "
+        f"p99={percentile(samples, 99) * 1000:9.3f}ms"
+        + (f"  {extra}" if extra else "")
+    )
@@ -0,0 +1,145 @@
+import random
+from datetime import date, timedelta
+from typing import List
+
+from sqlalchemy import text
+
+STATUSES = ("Shipped", "Invoiced", "Awaiting stock", "DS-Credit Review", "Picked", "In-transit")
+DELIVERY_STATUSES = ("On-Time", "Late Delivery", "Early Delivery", "No POD", None)
+CARRIERS = (("UPS", "UPS Ground"), ("FDX", "FedEx Express"), ("CPC", None))
+
+
+class Generator:
+    """
+    Writes synthetic wismo rows to a stand-in engine. Order numbers are
+    handed out in sequence and every draw comes from one seeded Random, so
+    the same calls always produce the same data.
+    """
+
+    def __init__(self, engine, seed: int = 1, product_count: int = 5000, first_order: int = 100000):
+        self.engine = engine
+        self.random = random.Random(seed)
+        self.product_count = product_count
+        self.next_order = first_order
+        self.next_carton = 1
+
+        self.orders = []
+        self.skus = []
+        self.cartons = []
+
+    def products(self) -> None:
+        rows = [
+            {"sku": f"SKU{i:06d}", "description": f"Product {i}", "manufacturer": f"Maker {i % 97}"}
+            for i in range(self.product_count)
+        ]
+        with self.engine.begin() as conn:
+            conn.execute(text("INSERT INTO wismo_products VALUES (:sku, :description, :manufacturer)"), rows)
+
+    def tree(self, depth: int, fan_out: int, suffixes: int = 1, skus: int = 4, cartons: int = 2) -> int:
+        """
+        Queue a split tree depth levels deep where every order splits into
+        fan_out orders, returns the root order number. Every node has
+        suffixes backorder levels with up to skus and cartons rows each.
+        """
+        root = self._order(None, skus, cartons, suffixes)
+        level = [root]
+        for _ in range(depth):
+            level = [
+                self._order(parent, skus, cartons, suffixes)
+                for parent in level
+                for _ in range(fan_out)
+            ]
+        return root
+
+    def chain(self, depth: int, **kwargs) -> int:
+        """A split tree with one order per level, the deepest shape for its size."""
+        return self.tree(depth, fan_out=1, **kwargs)
+
+    def wide(self, cartons: int, skus: int = 20) -> int:
+        """An unsplit order with exactly cartons cartons, each carton lists every sku."""
+        return self._order(None, skus, cartons, 1, exact=True)
+
+    def typical(self, count: int) -> List[int]:
+        """count small trees shaped like most real orders, mostly unsplit."""
+        roots = []
+        for _ in range(count):
+            depth = self.random.choices((0, 1, 2), weights=(80, 15, 5))[0]
+            roots.append(self.tree(depth, fan_out=self.random.randint(1, 2), suffixes=self.random.randint(1, 2)))
+        return roots
+
+    def flush(self) -> None:
+        """Write the queued rows."""
+        with self.engine.begin() as conn:
+            if self.orders:
+                conn.execute(text(
+                    "INSERT INTO wismo_orders VALUES (:number, :suffix, :original, :booked, :status,"
+                    " :name, :email, :phone, :shipto, :shiptoname)"
+                ), self.orders)
+            if self.skus:
+                conn.execute(text("INSERT INTO wismo_skus VALUES (:number, :suffix, :sku, :qty)"), self.skus)
+            if self.cartons:
+                conn.execute(text(
+                    "INSERT INTO wismo_cartons VALUES (:number, :suffix, :carton, :delivery, :actual,"
+                    " :expected, :carrier, :carrier_description, :link)"
+                ), self.cartons)
+        self.orders, self.skus, self.cartons = [], [], []
+
+    def _order(self, original, skus: int, cartons: int, suffixes: int, exact: bool = False) -> int:
+        number = self.next_order
+        self.next_order += 1
+        booked = date(2024, 1, 1) + timedelta(days=self.random.randint(0, 365))
+
+        for suffix in range(suffixes):
+            self.orders.append({
+                "number": number,
+                "suffix": suffix,
+                "original": original,
+                "booked": booked.isoformat(),
+                "status": self.random.choice(STATUSES),
+                "name": "Jane Doe",
+                "email": "jane@example.com",
+                "phone": 5550100,
+                "shipto": self.random.randint(1, 500),
+                "shiptoname": "Example Store",
+            })
+            for _ in range(skus if exact else self.random.randint(0, skus)):
+                self.skus.append({
+                    "number": number,
+                    "suffix": suffix,
+                    "sku": f"SKU{self.random.randrange(self.product_count):06d}",
+                    "qty": float(self.random.randint(1, 20)),
+                })
+            for _ in range(cartons if exact else self.random.randint(0, cartons)):
+                carrier, carrier_description = self.random.choice(CARRIERS)
+                delivered = self.random.random() < 0.5
+                self.cartons.append({
+                    "number": number,
+                    "suffix": suffix,
+                    "carton": self.next_carton,
+                    "delivery": self.random.choice(DELIVERY_STATUSES),
+                    "actual": (booked + timedelta(days=5)).isoformat() if delivered else None,
+                    "expected": (booked + timedelta(days=4)).isoformat(),
+                    "carrier": carrier,
+                    "carrier_description": carrier_description,
+                    "link": f"https://track.example.com/{self.next_carton}",
+                })
+                self.next_carton += 1
+        return number
+
+
+def populate(engine, seed: int = 1, typical: int = 1000, deep: int = 5, deep_depth: int = 40,
+             wide: int = 2, wide_cartons: int = 5000) -> dict:
+    """
+    Fill a stand-in with the benchmark scenarios, returns their root order
+    numbers: typical trees, deep split chains and orders with very many
+    cartons
+    """
+    generator = Generator(engine, seed=seed)
+    generator.products()
+    scenarios = {
+        "typical": generator.typical(typical),
+        "deep": [generator.chain(deep_depth) for _ in range(deep)],
+        "wide": [generator.wide(wide_cartons) for _ in range(wide)],
+    }
+    generator.flush()
+    return scenarios
@@ -0,0 +1,110 @@
+"""
+HTTP load scenario: runs the API with uvicorn against a SQLite stand-in
+for Snowflake and reports latency percentiles and queries per request.
+
+    python -m benchmarks.load [--requests 2000] [--concurrency 16] [--scenario typical]
+
+Order numbers are drawn with a Zipf-like skew so a few hot orders get
+most of the traffic, like the real order status lookups.
+"""
+import argparse
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+
+from benchmarks.common import percentile
+from benchmarks.data import populate
+from benchmarks.standin import QueryCounter, create_tables, make_engine
+from utils import connections
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int) -> uvicorn.Server:
+    import app
+
+    server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="bench-server", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def request(url: str) -> tuple:
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return time.perf_counter() - start, status
+
+
+def run_load(base_url: str, numbers: list, requests: int, concurrency: int, seed: int) -> tuple:
+    rnd = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(numbers))]
+    urls = [f"{base_url}/{number}" for number in rnd.choices(numbers, weights=weights, k=requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(request, urls))
+    return results, time.perf_counter() - start
+
+
+def summarise(name: str, results: list, elapsed: float, queries: int) -> None:
+    latencies = [latency for latency, _ in results]
+    errors = sum(1 for _, status in results if status >= 400)
+    print(
+        f"{name:<12} requests={len(results)} errors={errors} "
+        f"rps={len(results) / elapsed:8.1f} "
+        f"p50={percentile(latencies, 50) * 1000:8.2f}ms "
+        f"p99={percentile(latencies, 99) * 1000:8.2f}ms "
+        f"queries/request={queries / len(results):.2f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--scenario", default="typical", choices=("typical", "deep", "wide"))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # a file so every pooled connection sees the same data
+        engine = make_engine(os.path.join(tmp, "standin.sqlite"))
+        create_tables(engine)
+        scenarios = populate(engine, seed=args.seed, wide_cartons=500)
+        counter = QueryCounter(engine)
+
+        # the app asks the engine manager for its engine, hand it the stand-in
+        connections.engine_manager.factory = lambda: engine
+        server = start_server(free_port())
+        base_url = f"http://127.0.0.1:{server.config.port}"
+        numbers = scenarios[args.scenario]
+
+        # the first pass starts with an empty order cache, the second reuses it
+        for name in ("cold", "warm"):
+            counter.reset()
+            results, elapsed = run_load(base_url, numbers, args.requests, args.concurrency, args.seed)
+            summarise(name, results, elapsed, counter.reset())
+
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
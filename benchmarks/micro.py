@@ -0,0 +1,111 @@
+"""
+Microbenchmarks of the order path against a SQLite stand-in for Snowflake.
+
+    python -m benchmarks.micro [--only assembly,email,cache,queries] [--repeat 50]
+"""
+import argparse
+import os
+import tempfile
+from typing import List
+
+from benchmarks.common import measure, report
+from benchmarks.data import populate
+from benchmarks.standin import QueryCounter, create_tables, make_engine
+from utils import helper
+from utils.cache import MemoryBackend, ModelCodec, SQLiteBackend, TTLCache
+from utils.custom_types import OrderNumber
+from utils.email_generator import RENDERERS, generate_order_email
+
+
+def fetch_rows(engine, roots: list):
+    with engine.connect() as conn:
+        orders = helper.get_order_tree(roots, conn)
+        numbers = sorted({helper._order_key(order["postsplitordernumber"]) for order in orders})
+        return orders, helper.get_skus(numbers, conn), helper.get_cartons(numbers, conn)
+
+
+def bench_assembly(engine, scenarios: dict, repeat: int) -> None:
+    for name, roots in scenarios.items():
+        sample = roots[:50]
+        orders, skus, cartons = fetch_rows(engine, sample)
+        samples = measure(lambda: helper.build_order_tree(sample, orders, skus, cartons), repeat)
+        report(f"assembly/{name}", samples, f"{len(sample)} trees, {len(orders)} orders, {len(cartons)} cartons")
+
+
+def bench_email(engine, scenarios: dict, repeat: int) -> None:
+    for name, roots in scenarios.items():
+        orders, skus, cartons = fetch_rows(engine, roots[:1])
+        order = helper.build_order_tree(roots[:1], orders, skus, cartons)[roots[0]][0]
+        for format, render in RENDERERS.items():
+            report(f"email/{name}/{format}", measure(lambda: render(order), repeat))
+        generate_order_email(order, version="bench")
+        report(f"email/{name}/text cached", measure(lambda: generate_order_email(order, version="bench"), repeat))
+
+
+def bench_cache(engine, scenarios: dict, repeat: int, path: str) -> None:
+    roots = scenarios["typical"][:1] + scenarios["deep"][:1] + scenarios["wide"][:1]
+    orders, skus, cartons = fetch_rows(engine, roots)
+    tree = helper.build_order_tree(roots, orders, skus, cartons)
+    codec = ModelCodec(List[OrderNumber])
+
+    for name, root in zip(("typical", "deep", "wide"), roots):
+        value = tree[root]
+        encoded = codec.dumps(value)
+        report(f"codec/{name}/dumps", measure(lambda: codec.dumps(value), repeat), f"{len(encoded)} bytes")
+        report(f"codec/{name}/loads", measure(lambda: codec.loads(encoded), repeat))
+
+    memory = TTLCache(backend=MemoryBackend(max_entries=10000), sweep_interval=None)
+    keys = [f"order_{number}" for number in tree]
+    for key, number in zip(keys, tree):
+        memory.set(key, tree[number])
+    report("cache/memory/get", measure(lambda: [memory.get(key) for key in keys], repeat), f"{len(keys)} keys per call")
+
+    sqlite = TTLCache(backend=SQLiteBackend(path, codec=codec), sweep_interval=None)
+    for key, number in zip(keys, tree):
+        sqlite.set(key, tree[number])
+    report("cache/sqlite/get", measure(lambda: [sqlite.get(key) for key in keys], repeat), f"{len(keys)} keys per call")
+
+
+def bench_queries(engine, scenarios: dict, repeat: int) -> None:
+    counter = QueryCounter(engine)
+    for name, roots in scenarios.items():
+        def resolve():
+            with engine.connect() as conn:
+                helper._resolve_order_trees([roots[0]], conn, cache=False)
+
+        counter.reset()
+        samples = measure(resolve, repeat, warmup=0)
+        queries = counter.reset() / repeat
+        report(f"resolve/{name}", samples, f"{queries:.1f} queries per tree")
+
+
+BENCHMARKS = ("assembly", "email", "cache", "queries")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma separated benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--wide-cartons", type=int, default=5000)
+    parser.add_argument("--deep-depth", type=int, default=40)
+    args = parser.parse_args()
+
+    engine = make_engine()
+    create_tables(engine)
+    scenarios = populate(engine, seed=args.seed, deep_depth=args.deep_depth, wide_cartons=args.wide_cartons)
+
+    only = set(args.only.split(","))
+    if "assembly" in only:
+        bench_assembly(engine, scenarios, args.repeat)
+    if "email" in only:
+        bench_email(engine, scenarios, args.repeat)
+    if "cache" in only:
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_cache(engine, scenarios, args.repeat, os.path.join(tmp, "cache.sqlite"))
+    if "queries" in only:
+        bench_queries(engine, scenarios, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
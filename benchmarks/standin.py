@@ -0,0 +1,86 @@
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+from utils.connections import DB, SCHEMA
+
+# the columns the helpers read from each wismo table, every other column is ignored
+SCHEMA_SQL = (
+    """
+    CREATE TABLE wismo_orders (
+        postsplitordernumber INTEGER, ordersuffix INTEGER, originalordernumber INTEGER,
+        orderbookeddate TEXT, orderstatus TEXT, ordercontactfullname TEXT,
+        contactemailaddress TEXT, contactphone INTEGER, shipto INTEGER, shiptoname TEXT
+    )
+    """,
+    """
+    CREATE TABLE wismo_skus (
+        postsplitordernumber INTEGER, ordersuffix INTEGER, sku TEXT, pickqty REAL
+    )
+    """,
+    """
+    CREATE TABLE wismo_cartons (
+        postsplitordernumber INTEGER, ordersuffix INTEGER, cartonid INTEGER,
+        deliverystatusdescription TEXT, actualdeliverydate TEXT, expecteddeliverydate TEXT,
+        carriercode TEXT, carrierdescription TEXT, trace_and_trace_link TEXT
+    )
+    """,
+    """
+    CREATE TABLE wismo_products (
+        prod_sku TEXT, prod_hfadescription1 TEXT, prod_manufacturername TEXT
+    )
+    """,
+    "CREATE INDEX wismo_orders_number ON wismo_orders (postsplitordernumber)",
+    "CREATE INDEX wismo_orders_original ON wismo_orders (originalordernumber)",
+    "CREATE INDEX wismo_skus_number ON wismo_skus (postsplitordernumber)",
+    "CREATE INDEX wismo_cartons_number ON wismo_cartons (postsplitordernumber)",
+    "CREATE INDEX wismo_products_sku ON wismo_products (prod_sku)",
+)
+
+
+class QueryCounter:
+    """Counts the statements run on an engine, e.g. to report queries per request."""
+
+    def __init__(self, engine):
+        self.lock = threading.Lock()
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args) -> None:
+        with self.lock:
+            self.count += 1
+
+    def reset(self) -> int:
+        with self.lock:
+            count, self.count = self.count, 0
+        return count
+
+
+def make_engine(path: str = None):
+    """
+    A SQLite engine standing in for Snowflake, in memory unless path is
+    given. The DAGSTER_IO.DS_DEV. prefix of the helpers' table names is
+    stripped from every statement so they run unchanged. Pass it as the
+    sf_engine of run() and friends with lambda: engine.
+    """
+    if path is None:
+        engine = create_engine(
+            "sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False}
+        )
+    else:
+        engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+    prefix = f"{DB}.{SCHEMA}."
+
+    @event.listens_for(engine, "before_cursor_execute", retval=True)
+    def strip_prefix(conn, cursor, statement, parameters, context, executemany):
+        return statement.replace(prefix, ""), parameters
+
+    return engine
+
+
+def create_tables(engine) -> None:
+    with engine.begin() as conn:
+        for sql in SCHEMA_SQL:
+            conn.exec_driver_sql(sql)
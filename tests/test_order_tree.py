@@ -0,0 +1,137 @@
+"""
+build_order_tree must produce exactly what the original per-order lookups
+and nested scans produced. The legacy algorithm below is the original
+process_order_number, reading the same rows from memory instead of
+querying per order, with its loop variable shadowing fixed (the split
+order loop reused `order`, so later fields were read from the last split
+row).
+
+    python -m unittest discover tests
+"""
+import os
+import unittest
+
+for name in ("sf-account", "sf-username", "sf-password", "sf-role"):
+    os.environ.setdefault(name, "standin")
+
+from benchmarks.data import populate
+from benchmarks.standin import create_tables, make_engine
+from utils import helper
+from utils.constants import status_map
+from utils.custom_types import Carton, OrderNumber, Sku
+from utils.serialization import dump_orders
+
+
+def legacy_tree(order_number, orders: list, skus: list, cartons: list) -> list:
+    order_list = []
+    for order in orders:
+        if order['postsplitordernumber'] != order_number:
+            continue
+
+        sku_list = []
+        for sku in skus:
+            if sku['postsplitordernumber'] == order['postsplitordernumber'] and sku['ordersuffix'] == order['ordersuffix']:
+                pick_qty = None if sku["pickqty"] is None else int(float(sku["pickqty"]))
+                sku_list.append(Sku(
+                    orderNumber=int(sku["postsplitordernumber"]),
+                    orderSuffix=sku["ordersuffix"],
+                    sku=sku["sku"],
+                    pickQty=pick_qty
+                ))
+
+        carton_list = []
+        for carton in cartons:
+            carton_sku_list = []
+            for sku in skus:
+                if sku['postsplitordernumber'] == carton["postsplitordernumber"] and sku["ordersuffix"] == carton["ordersuffix"]:
+                    pick_qty = None if sku["pickqty"] is None else int(float(sku["pickqty"]))
+                    carton_sku_list.append(Sku(
+                        orderNumber=sku["postsplitordernumber"],
+                        orderSuffix=sku["ordersuffix"],
+                        sku=sku["sku"],
+                        pickQty=pick_qty
+                    ))
+
+            if carton['postsplitordernumber'] == order['postsplitordernumber'] and carton['ordersuffix'] == order['ordersuffix']:
+                carton_list.append(Carton(
+                    orderNumber=carton["postsplitordernumber"],
+                    orderSuffix=carton['ordersuffix'],
+                    cartonId=carton["cartonid"],
+                    deliveryStatusDescription=carton["deliverystatusdescription"],
+                    actualDeliveryDate=carton["actualdeliverydate"],
+                    expectedDeliveryDate=carton["expecteddeliverydate"],
+                    carrierCode=carton["carriercode"],
+                    carrierDescription=carton["carrierdescription"],
+                    traceAndTraceLink=carton["trace_and_trace_link"],
+                    skus=carton_sku_list
+                ))
+
+        split_orders = [row for row in orders if row['originalordernumber'] == order_number]
+        if split_orders:
+            split_order_list = []
+            for split_order in split_orders:
+                split_order_list.extend(legacy_tree(split_order['postsplitordernumber'], orders, skus, cartons))
+        else:
+            split_order_list = None
+
+        order_list.append(OrderNumber(
+            orderNumber=order_number,
+            orderBookedDate=order['orderbookeddate'],
+            orderSuffix=order['ordersuffix'],
+            orderStatus=status_map.get(order['orderstatus'], order['orderstatus']),
+            orderContactFullName=order['ordercontactfullname'],
+            contactEmailAddress=order['contactemailaddress'],
+            contactPhone=order['contactphone'],
+            shipTo=order['shipto'],
+            shipToName=order['shiptoname'],
+            splitOrders=split_order_list,
+            skus=sku_list,
+            cartons=carton_list
+        ))
+    return order_list
+
+
+class BuildOrderTreeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = make_engine()
+        create_tables(cls.engine)
+        scenarios = populate(cls.engine, typical=150, deep=3, deep_depth=8, wide=2, wide_cartons=40)
+        cls.roots = [root for roots in scenarios.values() for root in roots]
+
+    def fetch(self, roots: list):
+        with self.engine.connect() as conn:
+            orders = helper.get_order_tree(roots, conn)
+            numbers = sorted({helper._order_key(order['postsplitordernumber']) for order in orders})
+            return orders, helper.get_skus(numbers, conn), helper.get_cartons(numbers, conn)
+
+    def test_every_node_matches_legacy(self):
+        # the trees are built together, as a batch does, each compared on its own rows
+        orders, skus, cartons = self.fetch(self.roots)
+        tree = helper.build_order_tree(self.roots, orders, skus, cartons)
+        self.assertEqual(set(tree), {helper._order_key(order['postsplitordernumber']) for order in orders})
+
+        for root in self.roots:
+            root_orders, root_skus, root_cartons = self.fetch([root])
+            for number in sorted({helper._order_key(order['postsplitordernumber']) for order in root_orders}):
+                with self.subTest(order=number):
+                    self.assertEqual(
+                        dump_orders(tree[number]),
+                        dump_orders(legacy_tree(number, root_orders, root_skus, root_cartons))
+                    )
+
+    def test_models_equal_validated(self):
+        # the tree is built without validation, the models must not tell
+        orders, skus, cartons = self.fetch(self.roots[:1])
+        tree = helper.build_order_tree(self.roots[:1], orders, skus, cartons)
+        number = helper._order_key(self.roots[0])
+        self.assertEqual(tree[number], legacy_tree(number, orders, skus, cartons))
+
+    def test_missing_order_is_empty(self):
+        orders, skus, cartons = self.fetch([1])
+        self.assertEqual(helper.build_order_tree([1], orders, skus, cartons)[1], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,265 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional, Tuple
+
+from utils.metrics import Counter, Gauge, Histogram, registry
+
+# at most ADMISSION_MAX_CONCURRENT Snowflake queries of the async path run at
+# once, by default as many as there are query threads. Up to
+# ADMISSION_MAX_QUEUE more wait ADMISSION_QUEUE_TIMEOUT seconds for a slot,
+# anything beyond that is turned away with a 503 and Retry-After
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', os.getenv('SF_QUERY_WORKERS', 8)))
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', 200))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 10))
+ADMISSION_RETRY_AFTER = float(os.getenv('ADMISSION_RETRY_AFTER', 1))
+
+# every client address may make RATE_LIMIT_PER_SECOND requests a second with
+# bursts of RATE_LIMIT_BURST, 0 turns it off. RATE_LIMITS sets other limits
+# for some API keys, e.g. "partner-a=5/10,ops=50/100", a request is only
+# counted by its API_KEY_HEADER when the key is listed there
+RATE_LIMIT_PER_SECOND = float(os.getenv('RATE_LIMIT_PER_SECOND', 0))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 20))
+RATE_LIMITS = os.getenv('RATE_LIMITS', '')
+API_KEY_HEADER = os.getenv('API_KEY_HEADER', 'X-API-Key')
+
+# lanes in the order their queued queries are let through, background
+# refreshes of cached orders go last
+LANES = ("interactive", "batch", "background")
+BATCH_PATHS = ("/orders/batch", "/orders/export", "/email/")
+
+# the lane of the request being handled, set by the app's middleware
+current_lane: contextvars.ContextVar[str] = contextvars.ContextVar("current_lane", default="interactive")
+
+admission_active = registry.register(Gauge(
+    "wismo_admission_active", "Snowflake queries holding an admission slot"
+))
+admission_queue_depth = registry.register(Gauge(
+    "wismo_admission_queue_depth", "Snowflake queries waiting for an admission slot", ("lane",)
+))
+admission_wait_seconds = registry.register(Histogram(
+    "wismo_admission_wait_seconds", "Time queries waited for an admission slot", ("lane",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+))
+admission_rejections_total = registry.register(Counter(
+    "wismo_admission_rejections_total", "Requests turned away by admission control", ("reason", "lane")
+))
+
+
+def lane_for_path(path: str) -> str:
+    return "batch" if path.startswith(BATCH_PATHS) else "interactive"
+
+
+class Overloaded(Exception):
+    """A request that was not admitted, status and retry_after go in the response."""
+
+    def __init__(self, message: str, status: int = 503, retry_after: float = ADMISSION_RETRY_AFTER):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Caps the Snowflake queries running at once. A query that finds every
+    slot taken waits in the queue of its lane, a freed slot goes to the
+    oldest waiter of the first lane with one, so interactive lookups
+    overtake queued batch work. When the queues are full, or a query
+    waits longer than queue_timeout, Overloaded is raised instead.
+
+    Used from the event loop, threads outside it take a slot with
+    blocking_slot().
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = ADMISSION_MAX_CONCURRENT,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+        retry_after: float = ADMISSION_RETRY_AFTER,
+        lanes: Tuple[str, ...] = LANES,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.lanes = lanes
+        self.queues: Dict[str, deque] = {lane: deque() for lane in lanes}
+        self.active = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.admitted = 0
+        self.rejected = 0
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def acquire(self, lane: Optional[str] = None) -> None:
+        lane = lane or current_lane.get()
+        if lane not in self.queues:
+            lane = self.lanes[-1]
+        self.loop = asyncio.get_running_loop()
+
+        if self.active < self.max_concurrent and not self.queued():
+            self.active += 1
+            self._admit(lane, 0)
+            return
+        if self.queued() >= self.max_queue:
+            self._reject("queue_full", lane)
+            raise Overloaded("Too many queries waiting for Snowflake", retry_after=self.retry_after)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues[lane].append(waiter)
+        admission_queue_depth.set(len(self.queues[lane]), lane=lane)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._give_up(lane, waiter)
+            self._reject("queue_timeout", lane)
+            raise Overloaded("Timed out waiting for Snowflake", retry_after=self.retry_after)
+        except BaseException:
+            self._give_up(lane, waiter)
+            raise
+        # release() handed its slot over without giving it up
+        self._admit(lane, time.perf_counter() - start)
+
+    def release(self) -> None:
+        for lane in self.lanes:
+            queue = self.queues[lane]
+            while queue:
+                waiter = queue.popleft()
+                admission_queue_depth.set(len(queue), lane=lane)
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.active -= 1
+        admission_active.set(self.active)
+
+    @asynccontextmanager
+    async def slot(self, lane: Optional[str] = None):
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def blocking_slot(self, lane: Optional[str] = None):
+        """
+        slot() for a thread outside the event loop, it waits on the loop
+        that last took a slot. Before any has there is nothing to queue
+        behind and no slot is taken.
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            yield
+            return
+        asyncio.run_coroutine_threadsafe(self.acquire(lane or self.lanes[-1]), loop).result()
+        try:
+            yield
+        finally:
+            loop.call_soon_threadsafe(self.release)
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "queued": {lane: len(queue) for lane, queue in self.queues.items()},
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+    def _admit(self, lane: str, waited: float) -> None:
+        self.admitted += 1
+        admission_active.set(self.active)
+        admission_wait_seconds.observe(waited, lane=lane)
+
+    def _give_up(self, lane: str, waiter) -> None:
+        if waiter.done() and not waiter.cancelled():
+            # the slot was handed over just as the wait ended, pass it on
+            self.release()
+            return
+        try:
+            self.queues[lane].remove(waiter)
+        except ValueError:
+            pass
+        admission_queue_depth.set(len(self.queues[lane]), lane=lane)
+
+    def _reject(self, reason: str, lane: str) -> None:
+        self.rejected += 1
+        admission_rejections_total.inc(reason=reason, lane=lane)
+
+
+def parse_rate_limits(value: str) -> Dict[str, Tuple[float, float]]:
+    """Parse "key=rate/burst,..." into {key: (rate, burst)}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        key, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        limits[key.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+class RateLimiter:
+    """
+    A token bucket per client. Each bucket holds up to burst tokens and
+    refills at rate tokens a second, a request takes one. Only the
+    max_clients most recently seen clients are tracked, a client dropped
+    from the table starts again with a full bucket.
+    """
+
+    def __init__(
+        self,
+        rate: float = RATE_LIMIT_PER_SECOND,
+        burst: float = RATE_LIMIT_BURST,
+        overrides: Optional[Dict[str, Tuple[float, float]]] = None,
+        max_clients: int = 10000,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.overrides = overrides or {}
+        self.max_clients = max_clients
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.limited = 0
+
+    def client(self, api_key: Optional[str], address: str) -> str:
+        """
+        the bucket of a request, its API key if overrides lists it and its
+        address otherwise. Keys are not checked, counting unlisted ones
+        would let a client dodge its limit by sending a new key each time
+        """
+        return api_key if api_key in self.overrides else address
+
+    def take(self, client: str) -> float:
+        """Take a token for client, returns 0 or the seconds until one is available."""
+        rate, burst = self.overrides.get(client, (self.rate, self.burst))
+        if rate <= 0:
+            return 0
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+                self.limited += 1
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "clients": len(self.buckets),
+            "limited": self.limited,
+        }
@@ -1,61 +1,506 @@
-from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+import os
+import pickle
+import sqlite3
+import sys
 import threading
-from typing import Any, Optional, Dict, Tuple
+import time
+import zlib
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
 
-class TTLCache:
+
+def approximate_size(value: Any) -> int:
     """
-    A thread-safe cache with time-to-live (TTL) functionality.
-    Items automatically expire after the specified time period.
+    Roughly estimate the memory used by value in bytes by walking lists,
+    dicts and model attributes, good enough to cap the cache size
+    """
+    seen = set()
+    stack = [value]
+    size = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__"):
+            stack.append(item.__dict__)
+    return size
+
+
+class PickleCodec:
+    """Serialises any picklable value for the shared backends."""
+
+    def dumps(self, value: Any) -> bytes:
+        return zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def loads(self, data: bytes) -> Any:
+        return pickle.loads(zlib.decompress(data))
+
+
+class ModelCodec:
+    """
+    Serialises values of a pydantic type (e.g. List[OrderNumber]) as
+    compressed JSON, far more compact than pickling the model objects
+    """
+
+    def __init__(self, type_: Any):
+        from pydantic import TypeAdapter
+        self.adapter = TypeAdapter(type_)
+
+    def dumps(self, value: Any) -> bytes:
+        return zlib.compress(self.adapter.dump_json(value))
+
+    def loads(self, data: bytes) -> Any:
+        return self.adapter.validate_json(zlib.decompress(data))
+
+
+class CacheBackend:
+    """
+    Storage used by TTLCache. Backends store values with a time-to-live
+    and handle their own expiry and eviction.
+    """
+
+    name = "base"
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def get_with_ttl(self, key: str) -> Tuple[Optional[Any], float]:
+        """The value of key and the seconds it has left, (None, 0) if missing."""
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def cleanup_expired(self) -> int:
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class MemoryBackend(CacheBackend):
     """
-    
-    def __init__(self, ttl_hours: float = 1.0):
-        self.cache: Dict[str, Tuple[Any, datetime]] = {}
-        self.ttl = timedelta(hours=ttl_hours)
+    In-process LRU store. Once max_entries or max_bytes is reached the
+    least recently used items are evicted. Expired items are swept in
+    insertion order, so each sweep only touches items that have actually
+    expired.
+    """
+
+    name = "memory"
+
+    # expired items removed on each set(), keeps the work per call bounded
+    SWEEP_BATCH = 16
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = approximate_size,
+    ):
+        # key -> (value, expires_at, size), ordered from least to most recently used
+        self.cache: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        # (expires_at, key) in insertion order, every item of a cache shares
+        # the same ttl so this is also expiry order
+        self._expiry: Deque[Tuple[float, str]] = deque()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
         self.lock = threading.Lock()
-        
+
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
     def get(self, key: str) -> Optional[Any]:
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key: str) -> Tuple[Optional[Any], float]:
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None, 0
+
+            value, expires_at, _ = entry
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                self._remove(key)
+                self.expirations += 1
+                return None, 0
+
+            self.cache.move_to_end(key)
+            return value, remaining
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        now = time.monotonic()
+        expires_at = now + ttl
+
         with self.lock:
             if key in self.cache:
-                value, timestamp = self.cache[key]
-                if datetime.now() - timestamp < self.ttl:
-                    return value
-                else:
-                    del self.cache[key]
-            return None
-    
-    def set(self, key: str, value: Any) -> None:
+                self._remove(key)
+            self.cache[key] = (value, expires_at, size)
+            self.total_bytes += size
+            self._expiry.append((expires_at, key))
+
+            self._evict()
+            self._sweep(now, self.SWEEP_BATCH)
+
+    def delete(self, key: str) -> None:
         with self.lock:
-            self.cache[key] = (value, datetime.now())
-    
+            if key in self.cache:
+                self._remove(key)
+
     def clear(self) -> None:
         with self.lock:
             self.cache.clear()
-    
+            self._expiry.clear()
+            self.total_bytes = 0
+
+    def cleanup_expired(self) -> int:
+        with self.lock:
+            return self._sweep(time.monotonic())
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total_entries = len(self.cache)
+            total_bytes = self.total_bytes
+            evictions = self.evictions
+            expirations = self.expirations
+
+        return {
+            "total_entries": total_entries,
+            "max_entries": self.max_entries,
+            "approx_bytes": total_bytes if self.max_bytes is not None else None,
+            "max_bytes": self.max_bytes,
+            "evictions": evictions,
+            "expirations": expirations,
+        }
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self.cache.pop(key)
+        self.total_bytes -= size
+
+    def _evict(self) -> None:
+        while self.cache and (
+            (self.max_entries is not None and len(self.cache) > self.max_entries)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            key = next(iter(self.cache))
+            self._remove(key)
+            self.evictions += 1
+
+    def _sweep(self, now: float, limit: Optional[int] = None) -> int:
+        removed = 0
+        while self._expiry and (limit is None or removed < limit):
+            expires_at, key = self._expiry[0]
+            if expires_at > now:
+                break
+            self._expiry.popleft()
+            # the key may have been set again or evicted since this was queued
+            entry = self.cache.get(key)
+            if entry is not None and entry[1] == expires_at:
+                self._remove(key)
+                self.expirations += 1
+                removed += 1
+
+        # drop queue records left behind by overwritten or evicted keys
+        if len(self._expiry) > 2 * len(self.cache) + self.SWEEP_BATCH:
+            self._expiry = deque(
+                (expires_at, key)
+                for expires_at, key in self._expiry
+                if key in self.cache and self.cache[key][1] == expires_at
+            )
+        return removed
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    On-disk store shared by every worker on the host and kept across
+    restarts. Expiry uses wall clock time since it is shared between
+    processes, and once max_entries is reached the oldest writes are
+    evicted.
+    """
+
+    name = "sqlite"
+
+    # how many sets between checks of max_entries
+    EVICT_EVERY = 64
+
+    def __init__(self, path: str, codec: Any = None, max_entries: Optional[int] = None):
+        self.path = path
+        self.codec = codec or PickleCodec()
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._sets = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per thread, reopened after a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key: str) -> Tuple[Optional[Any], float]:
+        row = self._conn().execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None, 0
+        remaining = row[1] - time.time()
+        if remaining <= 0:
+            self.delete(key)
+            self.expirations += 1
+            return None, 0
+        return self.codec.loads(row[0]), remaining
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        data = self.codec.dumps(value)
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, data, time.time() + ttl),
+        )
+
+        self._sets += 1
+        if self.max_entries is not None and self._sets % self.EVICT_EVERY == 0:
+            (count,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN ("
+                    " SELECT key FROM cache ORDER BY expires_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                self.evictions += count - self.max_entries
+
+    def delete(self, key: str) -> None:
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        self._conn().execute("DELETE FROM cache")
+
     def cleanup_expired(self) -> int:
+        removed = self._conn().execute(
+            "DELETE FROM cache WHERE expires_at <= ?", (time.time(),)
+        ).rowcount
+        self.expirations += removed
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        (count,) = self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()
+        return {
+            "total_entries": count,
+            "max_entries": self.max_entries,
+            "path": self.path,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class RedisBackend(CacheBackend):
+    """
+    Store on a Redis-compatible server shared by every worker and host.
+    Expiry is done by the server and eviction by its maxmemory-policy.
+    Needs the optional redis package.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, codec: Any = None, prefix: str = "wismo:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.codec = codec or PickleCodec()
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[Any]:
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            return None
+        return self.codec.loads(data)
+
+    def get_with_ttl(self, key: str) -> Tuple[Optional[Any], float]:
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self.prefix + key)
+        pipe.pttl(self.prefix + key)
+        data, pttl = pipe.execute()
+        # pttl is negative when the key is gone or has no expiry
+        if data is None or pttl < 0:
+            return None, 0
+        return self.codec.loads(data), pttl / 1000
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self.client.set(self.prefix + key, self.codec.dumps(value), px=int(ttl * 1000))
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+    def clear(self) -> None:
+        keys = list(self.client.scan_iter(match=self.prefix + "*", count=1000))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"prefix": self.prefix}
+
+
+def make_backend(
+    kind: str = "memory",
+    url: Optional[str] = None,
+    codec: Any = None,
+    max_entries: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+) -> CacheBackend:
+    """
+    Build a cache backend from configuration, kind is memory, sqlite or
+    redis and url is the sqlite file path or the redis url
+    """
+    if kind == "memory":
+        return MemoryBackend(max_entries=max_entries, max_bytes=max_bytes)
+    if kind == "sqlite":
+        return SQLiteBackend(url or "wismo_cache.sqlite", codec=codec, max_entries=max_entries)
+    if kind == "redis":
+        return RedisBackend(url or "redis://localhost:6379/0", codec=codec)
+    raise ValueError(f"Unknown cache backend: {kind}")
+
+
+class TTLCache:
+    """
+    A thread-safe cache with time-to-live (TTL) functionality.
+    Items automatically expire after the specified time period. Storage is
+    delegated to a backend, by default an in-process LRU bounded by
+    max_entries/max_bytes, and expired items are swept in the background
+    every sweep_interval seconds.
+
+    With stale_hours set, ttl_hours is a soft TTL: items are kept for
+    stale_hours longer and lookup() reports their age, so callers can
+    serve a stale item while they refresh it. get() returns any item that
+    has not reached the hard TTL.
+    """
+
+    def __init__(
+        self,
+        ttl_hours: float = 1.0,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        sweep_interval: Optional[float] = 60.0,
+        backend: Optional[CacheBackend] = None,
+        stale_hours: float = 0,
+    ):
+        self.backend = backend or MemoryBackend(max_entries=max_entries, max_bytes=max_bytes)
+        self.ttl = ttl_hours * 3600
+        self.stale = stale_hours * 3600
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.backend.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def lookup(self, key: str) -> Tuple[Optional[Any], float]:
+        """
+        The value of key and its age in seconds, the value is stale once
+        the age reaches self.ttl. Returns (None, 0) on a miss.
+        """
+        value, remaining = self.backend.get_with_ttl(key)
+        age = self.ttl + self.stale - remaining
         with self.lock:
-            current_time = datetime.now()
-            expired_keys = [
-                key for key, (value, timestamp) in self.cache.items()
-                if current_time - timestamp >= self.ttl
-            ]
-            
-            for key in expired_keys:
-                del self.cache[key]
-            
-            return len(expired_keys)
-    
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if age >= self.ttl:
+                    self.stale_hits += 1
+        return value, age if value is not None else 0
+
+    def set(self, key: str, value: Any) -> None:
+        self.backend.set(key, value, self.ttl + self.stale)
+        self._ensure_sweeper()
+
+    def delete(self, key: str) -> None:
+        self.backend.delete(key)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def cleanup_expired(self) -> int:
+        return self.backend.cleanup_expired()
+
     def stats(self) -> Dict[str, Any]:
         with self.lock:
-            current_time = datetime.now()
-            valid_entries = sum(
-                1 for _, (_, timestamp) in self.cache.items()
-                if current_time - timestamp < self.ttl
+            hits = self.hits
+            misses = self.misses
+            stale_hits = self.stale_hits
+
+        lookups = hits + misses
+        return {
+            "backend": self.backend.name,
+            "ttl_hours": self.ttl / 3600,
+            "stale_hours": self.stale / 3600,
+            "hits": hits,
+            "misses": misses,
+            "stale_hits": stale_hits,
+            "hit_rate": hits / lookups if lookups else None,
+            **self.backend.stats(),
+        }
+
+    def close(self) -> None:
+        """Stop the background sweeper."""
+        self._stop.set()
+
+    def _ensure_sweeper(self) -> None:
+        if self.sweep_interval is None:
+            return
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        with self.lock:
+            if self._sweeper is not None and self._sweeper.is_alive():
+                return
+            self._sweeper = threading.Thread(
+                target=self._run_sweeper, name="ttl-cache-sweeper", daemon=True
             )
-            
-            return {
-                "total_entries": len(self.cache),
-                "valid_entries": valid_entries,
-                "expired_entries": len(self.cache) - valid_entries,
-                "ttl_hours": self.ttl.total_seconds() / 3600,
-                "cache_keys": list(self.cache.keys())
-            }
\ No newline at end of file
+            self._sweeper.start()
+
+    def _run_sweeper(self) -> None:
+        while not self._stop.wait(self.sweep_interval):
+            self.cleanup_expired()
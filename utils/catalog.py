@@ -0,0 +1,217 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+
+from utils.connections import DB, SCHEMA
+from utils.custom_types import Product
+
+logger = logging.getLogger(__name__)
+
+# file layout: header, index sorted by sku hash, then the records
+#   header  MAGIC, record count
+#   index   (sku hash, record offset, record length) per product
+#   record  sku \x1f description \x1f manufacturer, utf-8
+MAGIC = b"WISMOPC1"
+HEADER = struct.Struct("<8sI")
+INDEX_ENTRY = struct.Struct("<QQI")
+SEPARATOR = b"\x1f"
+
+
+def sku_hash(sku: str) -> int:
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(sku.encode(), digest_size=8).digest(), "little")
+
+
+def write_snapshot(path: str, rows) -> Tuple[int, int]:
+    """
+    Write a snapshot of (sku, description, manufacturer) rows to path.
+    The file is written next to path and renamed over it, so readers
+    always see a complete snapshot. Returns the number of products written
+    and the number of rows skipped
+    """
+    entries = []
+    skipped = 0
+    for sku, description, manufacturer in rows:
+        # rows with a NULL can't make a valid Product, the query path fails
+        # on them too
+        if any(value is None or value == "None" for value in (sku, description, manufacturer)):
+            skipped += 1
+            continue
+        record = SEPARATOR.join(str(value).encode() for value in (sku, description, manufacturer))
+        entries.append((sku_hash(str(sku)), record))
+    entries.sort(key=lambda entry: entry[0])
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    data_offset = HEADER.size + INDEX_ENTRY.size * len(entries)
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(entries)))
+        offset = data_offset
+        for hashed, record in entries:
+            f.write(INDEX_ENTRY.pack(hashed, offset, len(record)))
+            offset += len(record)
+        for _, record in entries:
+            f.write(record)
+    os.replace(tmp_path, path)
+    return len(entries), skipped
+
+
+class Snapshot:
+    """A read-only memory map of a snapshot file."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self.built_at = stat.st_mtime
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a product snapshot")
+
+    def _hash_at(self, i: int) -> int:
+        return INDEX_ENTRY.unpack_from(self.map, HEADER.size + i * INDEX_ENTRY.size)[0]
+
+    def get(self, sku: str) -> Optional[Product]:
+        hashed = sku_hash(sku)
+
+        # binary search for the first index entry with this hash
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._hash_at(mid) < hashed:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # entries sharing a hash are adjacent, compare the skus to skip collisions
+        encoded = sku.encode()
+        while lo < self.count:
+            entry_hash, offset, length = INDEX_ENTRY.unpack_from(self.map, HEADER.size + lo * INDEX_ENTRY.size)
+            if entry_hash != hashed:
+                break
+            record_sku, description, manufacturer = self.map[offset:offset + length].split(SEPARATOR, 2)
+            if record_sku == encoded:
+                return Product.model_construct(
+                    sku=sku,
+                    hfaDescription=description.decode(),
+                    manufacturerName=manufacturer.decode()
+                )
+            lo += 1
+        return None
+
+
+class ProductCatalog:
+    """
+    Serves products from a memory-mapped snapshot of wismo_products. Every
+    worker maps the same file, so the page cache holds one copy for all of
+    them. A background thread rebuilds the file every refresh_interval
+    seconds (one worker at a time, under a file lock) and every worker
+    remaps it when it changes.
+    """
+
+    def __init__(self, path: str, engine, refresh_interval: float = 3600, check_interval: float = 10):
+        self.path = path
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.check_interval = check_interval
+        self.snapshot: Optional[Snapshot] = None
+        self.builds = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def ready(self) -> bool:
+        return self.snapshot is not None
+
+    def lookup(self, skus: List[str]) -> List[Product]:
+        """Products for skus in request order, skus not in the snapshot are left out."""
+        snapshot = self.snapshot
+        products = []
+        for sku in dict.fromkeys(skus):
+            product = snapshot.get(sku)
+            if product is not None:
+                products.append(product)
+        return products
+
+    def build(self) -> int:
+        """Rebuild the snapshot file from Snowflake."""
+        full_table = f"{DB}.{SCHEMA}.{'wismo_products'}"
+        sql = f"""
+            SELECT prod_sku, prod_hfadescription1, prod_manufacturername
+            FROM {full_table}
+        """
+        with self.engine().connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=10000).execute(text(sql))
+            count, skipped = write_snapshot(self.path, result)
+        self.builds += 1
+        logger.info(f"Built product snapshot with {count} products")
+        if skipped:
+            logger.warning(f"Left {skipped} products with a NULL sku, description or manufacturer out of the snapshot")
+        return count
+
+    def refresh(self) -> None:
+        """Rebuild the snapshot if it is stale and map the latest file."""
+        if self._age() >= self.refresh_interval:
+            with open(f"{self.path}.lock", "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    pass  # another worker is building it
+                else:
+                    # it may have been rebuilt while we waited
+                    if self._age() >= self.refresh_interval:
+                        self.build()
+
+        self.reload()
+
+    def reload(self) -> None:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        current = self.snapshot
+        if current is None or current.identity != (stat.st_ino, stat.st_mtime_ns):
+            # readers keep a reference to the old map until they are done with it
+            self.snapshot = Snapshot(self.path)
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot
+        return {
+            "path": self.path,
+            "products": snapshot.count if snapshot else None,
+            "age_seconds": time.time() - snapshot.built_at if snapshot else None,
+            "builds": self.builds,
+        }
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="product-catalog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _age(self) -> float:
+        try:
+            return time.time() - os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return float("inf")
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Product snapshot refresh failed: {e}")
+            if self._stop.wait(self.check_interval):
+                return
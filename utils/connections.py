@@ -1,6 +1,7 @@
 import os
 from sqlalchemy import create_engine
 from pathlib import Path
+import threading
 import time
 
 DB = "DAGSTER_IO"
@@ -18,16 +19,33 @@ SF_PASSWORD = os.getenv('sf-password')
 SF_ROLE = os.getenv('sf-role')
 SF_WAREHOUSE = os.getenv('sf-warehouse')
 
-if not all([SF_ACCOUNT, SF_USERNAME, SF_PASSWORD, SF_ROLE]):
-    raise ValueError("Missing required Snowflake environment variables")
+ENGINE_TTL = float(os.getenv('ENGINE_TTL', 3600))  # 1 hour in seconds (adjust based on your token expiry)
 
-# Engine cache with timestamp
-_engine = None
-_engine_created_at = None
-ENGINE_TTL = os.getenv('ENGINE_TTL', 3600)  # 1 hour in seconds (adjust based on your token expiry)
+# connection pool settings, pool size plus overflow should cover SF_QUERY_WORKERS
+SF_POOL_SIZE = int(os.getenv('SF_POOL_SIZE', 8))
+SF_MAX_OVERFLOW = int(os.getenv('SF_MAX_OVERFLOW', 4))
+SF_POOL_TIMEOUT = float(os.getenv('SF_POOL_TIMEOUT', 30))  # seconds to wait for a free connection
+SF_POOL_RECYCLE = int(os.getenv('SF_POOL_RECYCLE', 1800))  # reconnect connections older than this
+SF_KEEP_ALIVE = os.getenv('SF_KEEP_ALIVE', 'true').lower() == 'true'
+
+# how long a rotated engine may wait for its checked out connections to come back
+ENGINE_DRAIN_TIMEOUT = float(os.getenv('ENGINE_DRAIN_TIMEOUT', 300))
+
+# connections opened at startup so the first request doesn't pay the login cost
+SF_WARMUP_CONNECTIONS = int(os.getenv('SF_WARMUP_CONNECTIONS', 2))
+
+# qmark binds parameters on the server so the statement text is the same for
+# every call and Snowflake can reuse its compiled plans and results,
+# pyformat interpolates them into the text on the client
+SF_PARAMSTYLE = os.getenv('SF_PARAMSTYLE', 'qmark')
+# tags every query of the service in Snowflake's query history
+SF_QUERY_TAG = os.getenv('SF_QUERY_TAG', 'wismo')
 
 def _create_engine():
     """Create a new Snowflake engine"""
+    if not all([SF_ACCOUNT, SF_USERNAME, SF_PASSWORD, SF_ROLE]):
+        raise ValueError("Missing required Snowflake environment variables")
+
     user = SF_USERNAME
     pwd = SF_PASSWORD
     acct = SF_ACCOUNT           # e.g., abc12345.us-east-1
@@ -41,21 +59,122 @@ def _create_engine():
     if params:
         url += "?" + "&".join(params)
 
-    return create_engine(url)
+    return create_engine(
+        url,
+        pool_size=SF_POOL_SIZE,
+        max_overflow=SF_MAX_OVERFLOW,
+        pool_timeout=SF_POOL_TIMEOUT,
+        pool_recycle=SF_POOL_RECYCLE,
+        pool_pre_ping=True,
+        paramstyle=SF_PARAMSTYLE,
+        connect_args={
+            "client_session_keep_alive": SF_KEEP_ALIVE,
+            "paramstyle": SF_PARAMSTYLE,
+            "session_parameters": {"QUERY_TAG": SF_QUERY_TAG}
+        }
+    )
+
+
+class EngineManager:
+    """
+    Hands out the shared engine and replaces it once it is older than ttl.
+    Rotation happens under a lock so concurrent requests create a single
+    engine, and the old engine is only disposed once the connections
+    checked out from it have been returned (or drain_timeout passes).
+    """
+
+    def __init__(self, factory=_create_engine, ttl: float = ENGINE_TTL, drain_timeout: float = ENGINE_DRAIN_TIMEOUT):
+        self.factory = factory
+        self.ttl = ttl
+        self.drain_timeout = drain_timeout
+        self.lock = threading.Lock()
+        self.rotations = 0
+
+        self._engine = None
+        self._created_at = None
+        # (engine, retired_at) waiting for their connections to come back
+        self._retired = []
+        self._drainer = None
+
+    def get(self):
+        engine, created_at = self._engine, self._created_at
+        if engine is not None and time.monotonic() - created_at < self.ttl:
+            return engine
+
+        with self.lock:
+            # another thread may have rotated while we waited for the lock
+            if self._engine is None or time.monotonic() - self._created_at >= self.ttl:
+                if self._engine is not None:
+                    self._retired.append((self._engine, time.monotonic()))
+                    self.rotations += 1
+                    self._start_drainer()
+                self._engine = self.factory()
+                self._created_at = time.monotonic()
+            return self._engine
+
+    def warm_up(self, connections: int = SF_WARMUP_CONNECTIONS) -> None:
+        """Open connections up front and leave them in the pool."""
+        engine = self.get()
+        opened = []
+        try:
+            for _ in range(connections):
+                opened.append(engine.connect())
+        finally:
+            for conn in opened:
+                conn.close()
+
+    def stats(self) -> dict:
+        engine, created_at = self._engine, self._created_at
+        if engine is None:
+            return {"engine": None, "rotations": self.rotations}
+
+        pool = engine.pool
+        stats = {
+            "engine_age_seconds": time.monotonic() - created_at,
+            "rotations": self.rotations,
+            "retired_engines": len(self._retired),
+        }
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            if hasattr(pool, name):
+                stats[f"pool_{name}"] = getattr(pool, name)()
+        return stats
+
+    def dispose(self) -> None:
+        with self.lock:
+            engines = [engine for engine, _ in self._retired]
+            if self._engine is not None:
+                engines.append(self._engine)
+            self._engine = None
+            self._created_at = None
+            self._retired = []
+        for engine in engines:
+            engine.dispose()
+
+    def _start_drainer(self) -> None:
+        # called with the lock held, the drainer clears itself under the lock
+        if self._drainer is not None:
+            return
+        self._drainer = threading.Thread(target=self._drain, name="engine-drain", daemon=True)
+        self._drainer.start()
+
+    def _drain(self) -> None:
+        while True:
+            with self.lock:
+                pending = []
+                for engine, retired_at in self._retired:
+                    checked_out = getattr(engine.pool, "checkedout", lambda: 0)()
+                    if checked_out == 0 or time.monotonic() - retired_at >= self.drain_timeout:
+                        engine.dispose()
+                    else:
+                        pending.append((engine, retired_at))
+                self._retired = pending
+                if not pending:
+                    self._drainer = None
+                    return
+            time.sleep(1)
+
+
+engine_manager = EngineManager()
 
 def sf_engine():
-    global _engine, _engine_created_at
-    current_time = time.time()
-    
-    # Create new engine if none exists or if TTL expired
-    if (_engine is None or 
-        _engine_created_at is None or 
-        current_time - _engine_created_at > ENGINE_TTL):
-        
-        if _engine is not None:
-            _engine.dispose()  # Clean up old engine
-        
-        _engine = _create_engine()
-        _engine_created_at = current_time
-    
-    return _engine
+    return engine_manager.get()
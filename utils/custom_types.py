@@ -35,6 +35,17 @@ class OrderNumber(BaseModel):
     skus: Optional[List['Sku']] = Field(description="this is the skus associated with this order, not including its split orders")
     cartons: Optional[List['Carton']] = Field(description="this is the cartons associated with this order, cartons are the units that we deliver in, each carton is delivered as a separate entity")
 
+class BatchOrderRequest(BaseModel):
+    orderNumbers: List[str] = Field(description="the order numbers to look up")
+
+class BatchOrderResult(BaseModel):
+    orders: Optional[List[OrderNumber]] = Field(default=None, description="the orders found for the order number, empty when it does not exist")
+    error: Optional[str] = Field(default=None, description="why the order number could not be looked up")
+
+class BatchEmailResult(BaseModel):
+    email: Optional[str] = Field(default=None, description="the rendered email for the main order")
+    error: Optional[str] = Field(default=None, description="why no email could be rendered for the order number")
+
 class ProductRequest(BaseModel):
     skus: List[str]
 
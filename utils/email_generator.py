@@ -1,13 +1,57 @@
 from datetime import datetime
+from html import escape
+from string import Template
 from typing import List, Optional
 from utils.custom_types import OrderNumber, Sku, Carton
 from utils.constants import DeliveryStatusType
+from utils.cache import TTLCache
+from utils.metrics import record_cache
+
+# The templates are compiled once at import. The text variant keeps the
+# exact layout of the original hand built email.
+TEXT_EMAIL = Template("""Dear <name>,
+
+Thank you for your order. Here are your order details:
+
+Order Number: $order_number
+Order Date: $order_date
+Order Status: $order_status
+
+Contact Information:
+Name: $name
+Email: $email
+Phone: $phone$sections
+
+Thank you for your business!
+If you have any questions about your order, please contact our customer service.""")
+
+HTML_EMAIL = Template("""<html>
+<body>
+<p>Dear &lt;name&gt;,</p>
+<p>Thank you for your order. Here are your order details:</p>
+<p>Order Number: $order_number<br>
+Order Date: $order_date<br>
+Order Status: $order_status</p>
+<h3>Contact Information</h3>
+<p>Name: $name<br>
+Email: $email<br>
+Phone: $phone</p>
+$sections
+<p>Thank you for your business!<br>
+If you have any questions about your order, please contact our customer service.</p>
+</body>
+</html>""")
+
+# rendered emails keyed by format, order and the version of the order they
+# were rendered from (the ETag of its cached order list), an unchanged order
+# is only rendered once
+email_cache = TTLCache(ttl_hours=24, max_entries=10000)
 
 def format_date(date: datetime) -> str:
     """Format a datetime object into a user-friendly string."""
     return date.strftime("%B %d, %Y")
 
-def format_status(status: OrderStatusType) -> str:
+def format_status(status: str) -> str:
     """Format the order status into a more readable format."""
     return status.replace("DS-", "").replace("-", " ").title()
 
@@ -17,117 +61,207 @@ def format_delivery_status(status: Optional[DeliveryStatusType]) -> str:
         return "Status Not Available"
     return status.replace("-", " ")
 
+def _sku_lines(lines: List[str], skus: List[Sku], heading: str, indent: str = "") -> None:
+    """Append the lines of a sku list, only the heading is indented."""
+    lines.append(f"{indent}{heading}")
+    for sku in skus:
+        if sku.pickQty:
+            lines.append(f"- SKU: {sku.sku or 'N/A'}, Quantity: {sku.pickQty}")
+        else:
+            lines.append(f"- SKU: {sku.sku or 'N/A'}")
+
+def _carton_lines(lines: List[str], cartons: List[Carton], indent: str = "") -> None:
+    """Append the lines of the carton tracking information at indent."""
+    lines.append(f"{indent}Shipping Information:")
+    for carton in cartons:
+        lines.append(indent)
+        lines.append(f"{indent}Carton ID: {carton.cartonId or 'N/A'}")
+        if carton.carrierDescription:
+            lines.append(f"{indent}Carrier: {carton.carrierDescription}")
+        lines.append(f"{indent}Delivery Status: {format_delivery_status(carton.deliveryStatusDescription)}")
+        if carton.expectedDeliveryDate:
+            lines.append(f"{indent}Expected Delivery: {format_date(carton.expectedDeliveryDate)}")
+        if carton.actualDeliveryDate:
+            lines.append(f"{indent}Actual Delivery: {format_date(carton.actualDeliveryDate)}")
+        if carton.traceAndTraceLink:
+            lines.append(f"{indent}Track Your Package: {carton.traceAndTraceLink}")
+        if carton.skus:
+            lines.append(f"{indent}Items in this carton:")
+            for sku in carton.skus:
+                lines.append(f"{indent}  - {sku.sku or 'N/A'}: {sku.pickQty or 0} units")
+
+def _split_order_lines(lines: List[str], orders: List[OrderNumber], indent_level: int = 0, prefix: str = "") -> None:
+    """
+    Append the lines of the split orders, nested splits are indented one
+    level deeper. The indent is passed down instead of re-indenting the
+    rendered text of every level.
+    """
+    indent = "  " * indent_level
+    lines.append(f"{prefix}{indent}This order has been split into the following orders:")
+
+    for split_order in orders:
+        if not isinstance(split_order, OrderNumber):
+            continue
+
+        lines.append("")
+        lines.append(f"{indent}Split Order: {split_order.orderNumber}-{split_order.orderSuffix}")
+        lines.append(f"{indent}Status: {format_status(split_order.orderStatus)}")
+
+        if split_order.skus:
+            _sku_lines(lines, split_order.skus, "Items in this split:", indent)
+
+        if split_order.cartons:
+            _carton_lines(lines, split_order.cartons, indent)
+
+        if split_order.splitOrders:
+            lines.append("")
+            _split_order_lines(lines, split_order.splitOrders, indent_level + 1, prefix=indent)
+
 def format_sku_list(skus: Optional[List[Sku]]) -> str:
     """Format a list of SKUs into a readable string."""
     if not skus:
         return "No items in this order"
-    
-    sku_parts = ["Order Items:"]
-    for sku in skus:
-        sku_info = f"- SKU: {sku.sku or 'N/A'}"
-        if sku.pickQty:
-            sku_info += f", Quantity: {sku.pickQty}"
-        sku_parts.append(sku_info)
-    
-    return "\n".join(sku_parts)
+    lines = []
+    _sku_lines(lines, skus, "Order Items:")
+    return "\n".join(lines)
 
 def format_cartons(cartons: Optional[List[Carton]]) -> str:
     """Format carton tracking information into a readable string."""
     if not cartons:
         return "No shipping information available"
-    
-    carton_parts = ["Shipping Information:"]
+    lines = []
+    _carton_lines(lines, cartons)
+    return "\n".join(lines)
+
+def format_split_orders(orders: Optional[List[OrderNumber]], indent_level: int = 0) -> str:
+    """Format split order information into a readable string."""
+    if not orders or not isinstance(orders, list):
+        return ""
+    lines = []
+    _split_order_lines(lines, orders, indent_level)
+    return "\n".join(lines)
+
+def _render_text(order: OrderNumber) -> str:
+    lines = []
+    if order.skus:
+        lines.append("")
+        _sku_lines(lines, order.skus, "Order Items:")
+    if order.cartons:
+        lines.append("")
+        _carton_lines(lines, order.cartons)
+    if order.splitOrders:
+        lines.append("")
+        _split_order_lines(lines, order.splitOrders)
+
+    return TEXT_EMAIL.substitute(
+        order_number=f"{order.orderNumber}-{order.orderSuffix}",
+        order_date=format_date(order.orderBookedDate),
+        order_status=format_status(order.orderStatus),
+        name=order.orderContactFullName,
+        email=order.contactEmailAddress,
+        phone=order.contactPhone,
+        sections="".join(f"\n{line}" for line in lines)
+    )
+
+def _html_skus(parts: List[str], skus: List[Sku], heading: str) -> None:
+    parts.append(f"<h4>{heading}</h4>\n<ul>")
+    for sku in skus:
+        quantity = f", Quantity: {sku.pickQty}" if sku.pickQty else ""
+        parts.append(f"<li>SKU: {escape(sku.sku or 'N/A')}{quantity}</li>")
+    parts.append("</ul>")
+
+def _html_cartons(parts: List[str], cartons: List[Carton]) -> None:
+    parts.append("<h4>Shipping Information</h4>")
     for carton in cartons:
-        carton_parts.append(f"\nCarton ID: {carton.cartonId or 'N/A'}")
+        parts.append(f"<p>Carton ID: {carton.cartonId or 'N/A'}<br>")
         if carton.carrierDescription:
-            carton_parts.append(f"Carrier: {carton.carrierDescription}")
-        
-        delivery_status = format_delivery_status(carton.deliveryStatusDescription)
-        carton_parts.append(f"Delivery Status: {delivery_status}")
-        
+            parts.append(f"Carrier: {escape(carton.carrierDescription)}<br>")
+        parts.append(f"Delivery Status: {escape(format_delivery_status(carton.deliveryStatusDescription))}<br>")
         if carton.expectedDeliveryDate:
-            carton_parts.append(f"Expected Delivery: {format_date(carton.expectedDeliveryDate)}")
-        
+            parts.append(f"Expected Delivery: {format_date(carton.expectedDeliveryDate)}<br>")
         if carton.actualDeliveryDate:
-            carton_parts.append(f"Actual Delivery: {format_date(carton.actualDeliveryDate)}")
-        
+            parts.append(f"Actual Delivery: {format_date(carton.actualDeliveryDate)}<br>")
         if carton.traceAndTraceLink:
-            carton_parts.append(f"Track Your Package: {carton.traceAndTraceLink}")
-            
+            link = escape(carton.traceAndTraceLink)
+            parts.append(f'<a href="{link}">Track Your Package</a>')
+        parts.append("</p>")
         if carton.skus:
-            sku_list = "\n".join(f"  - {sku.sku or 'N/A'}: {sku.pickQty or 0} units" 
-                                for sku in carton.skus)
-            carton_parts.append(f"Items in this carton:\n{sku_list}")
-    
-    return "\n".join(carton_parts)
+            parts.append("<ul>")
+            for sku in carton.skus:
+                parts.append(f"<li>{escape(sku.sku or 'N/A')}: {sku.pickQty or 0} units</li>")
+            parts.append("</ul>")
 
-def format_split_orders(orders: Optional[List[OrderNumber]], indent_level: int = 0) -> str:
-    """Format split order information into a readable string."""
-    if not orders or not isinstance(orders, list):
-        return ""
-    
-    indent = "  " * indent_level
-    split_parts = [f"{indent}This order has been split into the following orders:"]
-    
+def _html_split_orders(parts: List[str], orders: List[OrderNumber]) -> None:
+    parts.append('<div style="margin-left: 1em">\n<p>This order has been split into the following orders:</p>')
     for split_order in orders:
         if not isinstance(split_order, OrderNumber):
             continue
-            
-        split_parts.append(f"\n{indent}Split Order: {split_order.orderNumber}-{split_order.orderSuffix}")
-        split_parts.append(f"{indent}Status: {format_status(split_order.orderStatus)}")
-        
+        parts.append(
+            f"<p>Split Order: {split_order.orderNumber}-{split_order.orderSuffix}<br>"
+            f"Status: {escape(format_status(split_order.orderStatus))}</p>"
+        )
         if split_order.skus:
-            split_parts.append(f"{indent}{format_sku_list(split_order.skus).replace('Order Items:', 'Items in this split:')}")
-        
+            _html_skus(parts, split_order.skus, "Items in this split")
         if split_order.cartons:
-            # Indent the carton information for better readability
-            carton_info = format_cartons(split_order.cartons)
-            # Handle indentation line by line
-            indented_carton_info = "\n".join(f"{indent}{line}" for line in carton_info.split("\n"))
-            split_parts.append(indented_carton_info)
-            
+            _html_cartons(parts, split_order.cartons)
         if split_order.splitOrders:
-            # Recursively format any further split orders with increased indentation
-            further_splits = format_split_orders(split_order.splitOrders, indent_level + 1)
-            if further_splits:
-                split_parts.append(f"\n{indent}{further_splits}")
-    
-    return "\n".join(split_parts)
-
-def generate_order_email(order: OrderNumber) -> str:
-    """Generate an email for the given order."""
-    if not isinstance(order, OrderNumber):
-        raise TypeError("Expected OrderNumber object but received a different type")
-        
-    email_parts = []
-    
-    # Header with order information
-    email_parts.append(f"Dear <name>,")
-    email_parts.append(f"\nThank you for your order. Here are your order details:")
-    email_parts.append(f"\nOrder Number: {order.orderNumber}-{order.orderSuffix}")
-    email_parts.append(f"Order Date: {format_date(order.orderBookedDate)}")
-    email_parts.append(f"Order Status: {format_status(order.orderStatus)}")
-    
-    # Customer contact information
-    email_parts.append("\nContact Information:")
-    email_parts.append(f"Name: {order.orderContactFullName}")
-    email_parts.append(f"Email: {order.contactEmailAddress}")
-    email_parts.append(f"Phone: {order.contactPhone}")
-    
-    # Add SKU information
+            _html_split_orders(parts, split_order.splitOrders)
+    parts.append("</div>")
+
+def _render_html(order: OrderNumber) -> str:
+    parts = []
     if order.skus:
-        email_parts.append(f"\n{format_sku_list(order.skus)}")
-    
-    # Add carton tracking information
+        _html_skus(parts, order.skus, "Order Items")
     if order.cartons:
-        email_parts.append(f"\n{format_cartons(order.cartons)}")
-    
-    # Add split order information
+        _html_cartons(parts, order.cartons)
     if order.splitOrders:
-        email_parts.append(f"\n{format_split_orders(order.splitOrders)}")
-    
-    # Add footer
-    email_parts.append("\nThank you for your business!")
-    email_parts.append("If you have any questions about your order, please contact our customer service.")
-    
-    return "\n".join(email_parts)
\ No newline at end of file
+        _html_split_orders(parts, order.splitOrders)
+
+    return HTML_EMAIL.substitute(
+        order_number=f"{order.orderNumber}-{order.orderSuffix}",
+        order_date=format_date(order.orderBookedDate),
+        order_status=escape(format_status(order.orderStatus)),
+        name=escape(order.orderContactFullName),
+        email=escape(order.contactEmailAddress),
+        phone=order.contactPhone,
+        sections="\n".join(parts)
+    )
+
+RENDERERS = {"text": _render_text, "html": _render_html}
+
+def generate_order_email(order: OrderNumber, format: str = "text", version: Optional[str] = None) -> str:
+    """
+    Generate an email for the given order, format is text or html. version
+    identifies this content of the order, e.g. the ETag of the cached order
+    list it came from, and lets the email be served from email_cache.
+    Without it the email is always rendered, hashing the tree costs more
+    than rendering it.
+    """
+    if not isinstance(order, OrderNumber):
+        raise TypeError("Expected OrderNumber object but received a different type")
+    if format not in RENDERERS:
+        raise ValueError(f"Unknown email format: {format}")
+    if version is None:
+        return RENDERERS[format](order)
+
+    cache_key = f"{format}:{order.orderNumber}-{order.orderSuffix}:{version}"
+    email = email_cache.get(cache_key)
+    if email is None:
+        record_cache("email", "miss")
+        email = RENDERERS[format](order)
+        email_cache.set(cache_key, email)
+    else:
+        record_cache("email", "hit")
+    return email
+
+def generate_order_emails(orders: List[OrderNumber], format: str = "text", versions: Optional[List[Optional[str]]] = None) -> List[str]:
+    """
+    Generate the emails for many orders at once, e.g. for notification jobs.
+    versions gives the version of each order, e.g. the etag of its
+    CachedOrders, orders without one are always rendered.
+    """
+    if versions is None:
+        versions = [None] * len(orders)
+    elif len(versions) != len(orders):
+        raise ValueError("Expected a version for every order")
+    return [generate_order_email(order, format, version) for order, version in zip(orders, versions)]
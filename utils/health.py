@@ -0,0 +1,62 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+import os
+
+from sqlalchemy import text
+
+# seconds between readiness checks against Snowflake
+HEALTH_PROBE_INTERVAL = float(os.getenv('HEALTH_PROBE_INTERVAL', 60))
+
+
+class ReadinessProbe:
+    """
+    Checks the database on an interval in the background and keeps the
+    last result, so readiness probes never open a Snowflake session on
+    the request path.
+    """
+
+    def __init__(self, engine: Callable, interval: float = HEALTH_PROBE_INTERVAL):
+        self.engine = engine
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._result: Dict[str, Any] = {"ready": False, "database": "not checked yet"}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def check(self) -> Dict[str, Any]:
+        started = time.monotonic()
+        try:
+            with self.engine().connect() as conn:
+                conn.execute(text("SELECT 1"))
+            result = {"ready": True, "database": "connected"}
+        except Exception as e:
+            result = {"ready": False, "database": f"unavailable: {e}"}
+        result["latency_seconds"] = time.monotonic() - started
+        result["checked_at"] = time.time()
+
+        with self.lock:
+            self._result = result
+        return result
+
+    def result(self) -> Dict[str, Any]:
+        with self.lock:
+            result = dict(self._result)
+        if "checked_at" in result:
+            result["age_seconds"] = time.time() - result["checked_at"]
+        return result
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="readiness-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        self.check()
+        while not self._stop.wait(self.interval):
+            self.check()
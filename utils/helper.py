@@ -1,289 +1,992 @@
-
-from typing import Tuple
+import asyncio
+import contextvars
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from datetime import date, datetime, timedelta, timezone
+from typing import AsyncIterator, Iterator, List, NamedTuple, Optional, Tuple
 from utils.connections import DB, SCHEMA, sf_engine
-import pandas as pd
+from sqlalchemy import text
+from pydantic import TypeAdapter
 from utils.custom_types import OrderNumber, Carton, Sku, Product
 from utils.constants import status_map
-from utils.cache import TTLCache
-
-order_cache = TTLCache(ttl_hours=1)
+from utils.cache import TTLCache, ModelCodec, make_backend
+from utils.singleflight import AsyncSingleFlight, SingleFlight
+from utils.catalog import ProductCatalog
+from utils.refresh import BackgroundRefresher
+from utils.admission import AdmissionController, Overloaded
+from utils.serialization import content_etag, dump_orders, etag_matches, order_list_adapter
+from utils import queries
+from utils.metrics import record_cache, record_split_depth, timed, timed_query
+
+logger = logging.getLogger(__name__)
+
+# where cached orders are stored: memory (per worker), sqlite (shared by the
+# workers on a host, ORDER_CACHE_URL is the file path) or redis (shared by
+# every host, ORDER_CACHE_URL is the redis url)
+ORDER_CACHE_BACKEND = os.getenv('ORDER_CACHE_BACKEND', 'memory')
+ORDER_CACHE_URL = os.getenv('ORDER_CACHE_URL')
+
+# bounds for the order cache, a long running worker would otherwise keep every order it has served
+ORDER_CACHE_MAX_ENTRIES = int(os.getenv('ORDER_CACHE_MAX_ENTRIES', 10000))
+ORDER_CACHE_MAX_MB = os.getenv('ORDER_CACHE_MAX_MB')
+
+# with CHANGE_DETECTION on, changed orders are dropped from the cache as soon
+# as they are seen so the TTL can be raised well above the default hour
+ORDER_CACHE_TTL_HOURS = float(os.getenv('ORDER_CACHE_TTL_HOURS', 1))
+# how long past the TTL an order may still be served while it is refreshed
+# in the background, 0 makes requests wait for expired orders again
+ORDER_CACHE_STALE_HOURS = float(os.getenv('ORDER_CACHE_STALE_HOURS', 1))
+
+class CachedOrders(NamedTuple):
+    """
+    an order list as kept in the order cache, with the ETag of its JSON so
+    a conditional request is answered without serialising the tree. Split
+    orders cached along with a requested tree have no ETag, it is worked
+    out when they are served
+    """
+    orders: List[OrderNumber]
+    etag: Optional[str] = None
+
+order_cache = TTLCache(
+    ttl_hours=ORDER_CACHE_TTL_HOURS,
+    stale_hours=ORDER_CACHE_STALE_HOURS,
+    backend=make_backend(
+        ORDER_CACHE_BACKEND,
+        url=ORDER_CACHE_URL,
+        codec=ModelCodec(CachedOrders),
+        max_entries=ORDER_CACHE_MAX_ENTRIES,
+        max_bytes=int(float(ORDER_CACHE_MAX_MB) * 1024 * 1024) if ORDER_CACHE_MAX_MB else None
+    )
+)
+
+# ORDER_CACHE_BYTES=true also keeps the JSON of the orders cached, keyed by
+# their ETag, so a cache hit is sent without serialising the tree again. It
+# is kept in the worker whatever ORDER_CACHE_BACKEND is
+ORDER_CACHE_BYTES = os.getenv('ORDER_CACHE_BYTES', 'false').lower() == 'true'
+order_bytes_cache = TTLCache(
+    ttl_hours=ORDER_CACHE_TTL_HOURS + ORDER_CACHE_STALE_HOURS,
+    max_entries=ORDER_CACHE_MAX_ENTRIES
+)
+
+# orders requested ORDER_HOT_HITS times within ORDER_HOT_WINDOW seconds are
+# refreshed once ORDER_REFRESH_AHEAD of their TTL has passed, before they go
+# stale. ORDER_REFRESH_CONCURRENCY caps the refresh queries running at once
+ORDER_HOT_HITS = int(os.getenv('ORDER_HOT_HITS', 10))
+ORDER_HOT_WINDOW = float(os.getenv('ORDER_HOT_WINDOW', 300))
+ORDER_REFRESH_AHEAD = float(os.getenv('ORDER_REFRESH_AHEAD', 0.8))
+ORDER_REFRESH_CONCURRENCY = int(os.getenv('ORDER_REFRESH_CONCURRENCY', 2))
+
+order_refresher = BackgroundRefresher(
+    max_concurrent=ORDER_REFRESH_CONCURRENCY,
+    hot_hits=ORDER_HOT_HITS,
+    hot_window=ORDER_HOT_WINDOW
+)
+
+# products rarely change so they are cached per sku for a long time, skus
+# that don't exist are remembered for a shorter time so they can show up later
+PRODUCT_CACHE_TTL_HOURS = float(os.getenv('PRODUCT_CACHE_TTL_HOURS', 24))
+PRODUCT_MISSING_TTL_HOURS = float(os.getenv('PRODUCT_MISSING_TTL_HOURS', 1))
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv('PRODUCT_CACHE_MAX_ENTRIES', 200000))
+# largest IN (...) list sent for the skus that missed the cache
+PRODUCT_CHUNK_SIZE = int(os.getenv('PRODUCT_CHUNK_SIZE', 500))
+# number of the most ordered products cached at startup, 0 turns it off
+PRODUCT_PRELOAD_COUNT = int(os.getenv('PRODUCT_PRELOAD_COUNT', 0))
+
+product_cache = TTLCache(ttl_hours=PRODUCT_CACHE_TTL_HOURS, max_entries=PRODUCT_CACHE_MAX_ENTRIES)
+missing_product_cache = TTLCache(ttl_hours=PRODUCT_MISSING_TTL_HOURS, max_entries=PRODUCT_CACHE_MAX_ENTRIES)
+
+# PRODUCT_SOURCE=snapshot answers product lookups from a local memory-mapped
+# snapshot of wismo_products shared by the workers and rebuilt every
+# PRODUCT_SNAPSHOT_REFRESH seconds, until the first snapshot exists lookups
+# still go to Snowflake
+PRODUCT_SOURCE = os.getenv('PRODUCT_SOURCE', 'snowflake')
+PRODUCT_SNAPSHOT_PATH = os.getenv('PRODUCT_SNAPSHOT_PATH', 'wismo_products.snapshot')
+PRODUCT_SNAPSHOT_REFRESH = float(os.getenv('PRODUCT_SNAPSHOT_REFRESH', 3600))
+
+product_catalog = ProductCatalog(
+    PRODUCT_SNAPSHOT_PATH,
+    sf_engine,
+    refresh_interval=PRODUCT_SNAPSHOT_REFRESH
+) if PRODUCT_SOURCE == 'snapshot' else None
+
+# coalesce concurrent lookups of the same order / sku list into one fetch
+order_flight = SingleFlight("order")
+product_flight = SingleFlight("product")
+async_order_flight = AsyncSingleFlight("order")
+async_product_flight = AsyncSingleFlight("product")
+
+# threads running Snowflake queries for the async path, keep this within
+# the connection pool size so queries don't queue on the pool instead
+SF_QUERY_WORKERS = int(os.getenv('SF_QUERY_WORKERS', 8))
+query_executor = ThreadPoolExecutor(max_workers=SF_QUERY_WORKERS, thread_name_prefix="sf-query")
+
+# every query of the async path takes a slot first, so a burst queues here
+# in priority order instead of on the pool, see utils.admission
+admission = AdmissionController()
+
+# limits for POST /orders/batch, chunks are resolved concurrently with a
+# fixed number of queries each
+BATCH_MAX_ORDERS = int(os.getenv('BATCH_MAX_ORDERS', 1000))
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', 200))
+
+# root orders resolved per page by the streaming export
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 500))
+
+# ORDER_TREE_SOURCE=materialized reads each full tree from the table kept up
+# to date by utils.materialize, orders without a row there are still
+# assembled from the wismo tables
+ORDER_TREE_SOURCE = os.getenv('ORDER_TREE_SOURCE', 'live')
+
+# the change watermark each order was last invalidated at, a materialised
+# row built before it is assembled live instead until the row is rebuilt
+materialized_changes = TTLCache(ttl_hours=24, max_entries=ORDER_CACHE_MAX_ENTRIES)
+
+# the wismo rows are typed by Snowflake, so the models are built without
+# validation. TRUST_DB_ROWS=false validates every model again, e.g. to find
+# rows that don't fit them
+TRUST_DB_ROWS = os.getenv('TRUST_DB_ROWS', 'true').lower() == 'true'
+
+# guards the recursive split tree query against cycles in ORIGINALORDERNUMBER
+MAX_SPLIT_DEPTH = 50
+
+class TreeOptions(NamedTuple):
+    """
+    what to resolve for an order tree. max_depth is the number of split
+    order levels below the order, None follows every split. Leaving out
+    skus or cartons skips their query, cartons then list no skus
+    """
+    max_depth: Optional[int] = None
+    skus: bool = True
+    cartons: bool = True
+
+    @property
+    def cache_suffix(self) -> str:
+        # the full tree keeps the plain order_{number} key
+        if self == FULL_TREE:
+            return ""
+        depth = "all" if self.max_depth is None else self.max_depth
+        return f":d{depth}s{int(self.skus)}c{int(self.cartons)}"
+
+FULL_TREE = TreeOptions()
+
+def tree_options(max_depth: Optional[int] = None, skus: bool = True, cartons: bool = True, split_orders: bool = True) -> TreeOptions:
+    """TreeOptions from the query parameters, equal requests always give equal options."""
+    if not split_orders:
+        max_depth = 0
+    elif max_depth is not None and max_depth >= MAX_SPLIT_DEPTH:
+        max_depth = None
+    return TreeOptions(max_depth, skus, cartons)
+
+# the cache suffixes of the partial trees this worker has cached, so
+# invalidation can drop every variant of an order
+_cached_variants = set()
 
 def process_none(value):
-    import pandas as pd
-    if value == "None" or pd.isna(value):
+    # value != value is only true for NaN
+    if value is None or value == "None" or value != value:
         return None
     else:
         return value
 
-
-def check_in_original(order_number: str, conn) -> bool:
+def fetch_rows(sql, conn, clean: bool = True, params: dict = None) -> list:
     """
-    Check if the row exists in DAGSTER_IO.DS_DEV.CHURN_READ_SQL
-    where ORDERNUMBER equals the given order_number.
+    Run sql, a SQL string or a statement from utils.queries, on conn with
+    params bound and return the rows as dicts keyed by column name. The
+    rows are read straight from the DBAPI cursor, clean runs process_none
+    over every value
     """
-    # Compose the full table reference safely
-    full_table = f"{DB}.{SCHEMA}.{'wismo_orders'}"
-    sql = f"""
-        SELECT 1
-        FROM {full_table}
-        WHERE ORIGINALORDERNUMBER = {order_number}
+    statement = text(sql) if isinstance(sql, str) else sql
+    result = conn.execute(statement, params or {})
+    columns = list(result.keys())
+
+    if clean:
+        return [dict(zip(columns, map(process_none, row))) for row in result]
+    return [dict(zip(columns, row)) for row in result]
+
+def _order_key(value):
     """
-    df = pd.read_sql(sql, conn)
+    Normalise an order number read from any of the wismo tables so rows
+    can be matched in memory, NULL/NaN parents map to None
+    """
+    if value is None or value != value:
+        return None
+    return int(value)
 
-    return not df.empty
+@timed_query
+def get_order_tree(order_numbers: list, conn, max_depth: int = None) -> list:
+    """
+    Get every wismo_orders row in the split trees below order_numbers in a
+    single query, the split orders are found by walking ORIGINALORDERNUMBER
+    with a recursive CTE instead of querying each node separately. Only
+    max_depth levels of split orders are fetched when it is given
+    """
+    if not order_numbers:
+        return []
 
-def get_orders(order_number:int, conn) -> list:
+    depth_limit = MAX_SPLIT_DEPTH if max_depth is None else min(max_depth, MAX_SPLIT_DEPTH)
+    params = {
+        "numbers": queries.pad_values([_order_key(number) for number in order_numbers]),
+        "depth_limit": depth_limit
+    }
+    return fetch_rows(queries.ORDER_TREE, conn, clean=False, params=params)
 
-    # Compose the full table reference safely
-    full_table = f"{DB}.{SCHEMA}.{'wismo_orders'}"
-    sql = f"""
-        SELECT *
-        FROM {full_table}
-        WHERE postsplitordernumber = {order_number}
+@timed_query
+def get_skus(order_numbers: list, conn) -> list:
+    """
+    Get the skus for every postsplitordernumber in order_numbers
     """
+    if not order_numbers:
+        return []
 
-    df = pd.read_sql(sql, conn)
+    return fetch_rows(queries.SKUS, conn, params={"numbers": queries.pad_values(order_numbers)})
 
-    if df.empty:
+@timed_query
+def get_cartons(order_numbers: list, conn) -> list:
+    """
+    Get the cartons for every postsplitordernumber in order_numbers
+    """
+    if not order_numbers:
         return []
-    
-    rows = [
-        {k: v for k, v in row.items()}
-        for _, row in df.iterrows()
-    ]
 
-    return rows
+    return fetch_rows(queries.CARTONS, conn, params={"numbers": queries.pad_values(order_numbers)})
 
-def original_order_query(order_number, conn):
-    full_table = f"{DB}.{SCHEMA}.{'wismo_orders'}"
-    sql = f"""
-    SELECT *
-    FROM {full_table}
-    WHERE ORIGINALORDERNUMBER = {order_number}
+@timed_query
+def get_materialized_tree(order_number, conn) -> Optional[list]:
     """
-    df = pd.read_sql(sql, conn)
+    The precomputed order list of order_number, None when the order has no
+    row in the materialised tree table yet, or only one built before the
+    order last changed
+    """
+    row = conn.execute(queries.MATERIALIZED_TREE, {"number": _order_key(order_number)}).fetchone()
+    if row is None:
+        record_cache("materialized", "miss")
+        return None
 
-    rows = [
-        {k: process_none(v) for k, v in row.items()}
-        for _, row in df.iterrows()
-    ]
+    cache_key = f"order_{_order_key(order_number)}"
+    changed_at = materialized_changes.get(cache_key)
+    if changed_at is not None:
+        if _as_utc(row[1]) < changed_at:
+            record_cache("materialized", "stale")
+            return None
+        materialized_changes.delete(cache_key)
+    record_cache("materialized", "hit")
+    return order_list_adapter.validate_json(row[0])
+
+def _product_from_row(item: dict) -> Product:
+    return Product(
+        sku=item.get("prod_sku"),
+        hfaDescription=item.get("prod_hfadescription1"),
+        manufacturerName=item.get("prod_manufacturername")
+    )
+
+@timed_query
+def query_products(skus: list, conn) -> list:
+    """
+    Get the products from DAGSTER_IO.DS_DEV.WISMO_PRODUCTS
+    where skus is a list of the skus, errors are raised
+    """
+    if not skus:
+        return []
 
-    return rows
+    # the skus are bound, so quotes in a sku can't break the statement
+    rows = fetch_rows(queries.PRODUCTS, conn, params={"skus": queries.pad_values(skus)})
+    logger.debug(f"Query executed successfully. Rows returned: {len(rows)}")
+    return [_product_from_row(item) for item in rows]
 
-def get_skus(order_number, conn):
-    # Compose the full table reference safely
-    full_table = f"{DB}.{SCHEMA}.{'wismo_skus'}"
-    sql = f"""
-        SELECT *
-        FROM {full_table}
-        WHERE postsplitordernumber = {order_number}
+def _cached_products(skus: list) -> Tuple[dict, list]:
     """
-    df = pd.read_sql(sql, conn)
+    splits skus into the products already cached and the skus that still
+    have to be fetched, skus cached as missing are neither
+    """
+    products = {}
+    misses = []
+    for sku in dict.fromkeys(skus):
+        product = product_cache.get(sku)
+        if product is not None:
+            products[sku] = product
+            record_cache("product", "hit")
+        elif missing_product_cache.get(sku) is None:
+            misses.append(sku)
+            record_cache("product", "miss")
+        else:
+            record_cache("product", "missing")
+    return products, misses
 
-    rows = [
-        {k: process_none(v) for k, v in row.items()}
-        for _, row in df.iterrows()
-    ]
+def fetch_products(skus: list, conn) -> dict:
+    """
+    queries the products for skus in chunks of PRODUCT_CHUNK_SIZE and
+    caches them, skus that don't exist are cached as missing for a
+    shorter time. Returns a dict of sku -> Product
+    """
+    products = {}
+    for i in range(0, len(skus), PRODUCT_CHUNK_SIZE):
+        chunk = skus[i:i + PRODUCT_CHUNK_SIZE]
+        for product in query_products(chunk, conn):
+            product_cache.set(product.sku, product)
+            products[product.sku] = product
+        for sku in chunk:
+            if sku not in products:
+                missing_product_cache.set(sku, True)
+    return products
 
-    return rows
+def _in_request_order(skus: list, products: dict) -> list:
+    return [products[sku] for sku in dict.fromkeys(skus) if sku in products]
 
-def get_cartons(order_number: str, conn) -> list:
+def preload_products(count: int = None, sf_engine = sf_engine) -> int:
     """
-    Get the cartons from DAGSTER_IO.DS_DEV.CHURN_READ_SQL
-    where ORDERNUMBER equals the given order_number.
+    caches the products of the count skus that appear on the most order
+    lines, so the common products are served from memory from the start
     """
+    count = PRODUCT_PRELOAD_COUNT if count is None else count
+    if count <= 0:
+        return 0
 
-    # Compose the full table reference safely
-    full_table = f"{DB}.{SCHEMA}.{'wismo_cartons'}"
+    products_table = f"{DB}.{SCHEMA}.{'wismo_products'}"
+    skus_table = f"{DB}.{SCHEMA}.{'wismo_skus'}"
     sql = f"""
-        SELECT *
-        FROM {full_table}
-        WHERE postsplitordernumber = {order_number}
+        SELECT p.*
+        FROM {products_table} p
+        JOIN (
+            SELECT sku, COUNT(*) AS lines
+            FROM {skus_table}
+            GROUP BY sku
+            ORDER BY lines DESC
+            LIMIT {int(count)}
+        ) hot
+            ON p.PROD_SKU = hot.sku
     """
+    with sf_engine().connect() as conn:
+        rows = fetch_rows(sql, conn)
 
-    df = pd.read_sql(sql, conn)
+    for item in rows:
+        product = _product_from_row(item)
+        product_cache.set(product.sku, product)
+    logger.info(f"Preloaded {len(rows)} products")
+    return len(rows)
 
-    if df.empty:
-        return []
-    
-    rows = [
-        {k: process_none(v) for k, v in row.items()}
-        for _, row in df.iterrows()
-    ]
+_datetime_adapter = TypeAdapter(datetime)
 
-    return rows
+def _to_int(value):
+    return None if value is None else int(value)
 
-def get_products(skus: list, conn) -> list:
+def _to_datetime(value):
+    # snowflake returns datetimes already, anything else is parsed like pydantic would
+    if value is None or isinstance(value, datetime):
+        return value
+    return _datetime_adapter.validate_python(value)
+
+def _as_utc(value) -> datetime:
+    # built_at is naive UTC, a watermark can carry a time zone
+    value = _to_datetime(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _model(model, **fields):
     """
-    Get the products from DAGSTER_IO.DS_DEV.WISMO_PRODUCTS
-    where skus is a list of the skus.
+    builds model from fields that already have the field types, without
+    validation unless TRUST_DB_ROWS is off
     """
-    
-    if not skus:
-        return []
-    
-    # Compose the full table reference safely
-    full_table = f"{DB}.{SCHEMA}.{'wismo_products'}"
-    
-    # Create placeholders for the IN clause
-    sku_list ="'" +  "','".join(skus) + "'"
-    sql = f"""
-        SELECT *
-        FROM {full_table}
-        WHERE PROD_SKU IN ({sku_list})
+    if not TRUST_DB_ROWS:
+        return model(**fields)
+    return model.model_construct(**fields)
+
+def _build_skus(skus: list) -> list:
     """
-    
-    try:
-        df = pd.read_sql(sql, conn)
-        print(f"Query executed successfully. Rows returned: {len(df)}")
-        print(f"DataFrame: {df}")
-    except Exception as e:
-        print(f"Error executing query: {e}")
-        return []
-    
-    products = []
+    builds the Sku objects for the sku rows of one order, the same objects
+    are shared by the order and each of its cartons
+    """
+    sku_list = []
+    for sku in skus:
+        pick_qty = None if sku["pickqty"] is None else int(float(sku["pickqty"]))
+        sku_list.append(
+            _model(
+                Sku,
+                orderNumber=int(sku["postsplitordernumber"]),
+                orderSuffix=int(sku["ordersuffix"]),
+                sku=sku["sku"],
+                pickQty=pick_qty
+            )
+        )
+    return sku_list
 
-    rows = [
-        {k: process_none(v) for k, v in row.items()}
-        for _, row in df.iterrows()
-    ]
+def _assemble_orders(order_number, orders: list, skus_by_order: dict, cartons_by_order: dict, split_order_list, options: TreeOptions = FULL_TREE) -> list:
+    """
+    builds the OrderNumber objects for a single postsplitordernumber,
+    skus_by_order and cartons_by_order hold the rows of the tree grouped by
+    (postsplitordernumber, ordersuffix) and split_order_list is the already
+    built list of split orders. Parts left out by options are None
+    """
+    # create an empty list to hold OrderNumber objects
+    order_list = []
 
-    for item in rows:
-        product = Product(
-            sku=item.get("prod_sku"),
-            hfaDescription=item.get("prod_hfadescription1"),
-            manufacturerName=item.get("prod_manufacturername")
+    # iterate through each order that appears under the postsplitordernumber
+    for order in orders:
+        order_key = (_order_key(order['postsplitordernumber']), order['ordersuffix'])
+
+        # every sku of the order, each carton of the order lists all of them
+        sku_list = _build_skus(skus_by_order.get(order_key, []))
+
+        carton_list = []
+        for carton in cartons_by_order.get(order_key, []):
+            carton_list.append(
+                _model(
+                    Carton,
+                    orderNumber=int(carton["postsplitordernumber"]),
+                    orderSuffix=int(carton['ordersuffix']),
+                    cartonId=_to_int(carton["cartonid"]),
+                    deliveryStatusDescription=carton["deliverystatusdescription"],
+                    expectedDeliveryDate=_to_datetime(carton["expecteddeliverydate"]),
+                    actualDeliveryDate=_to_datetime(carton["actualdeliverydate"]),
+                    carrierCode=carton["carriercode"],
+                    carrierDescription=carton["carrierdescription"],
+                    traceAndTraceLink=carton["trace_and_trace_link"],
+                    skus=sku_list
+                )
+            )
+
+        order_list.append(
+            _model(
+                OrderNumber,
+                orderNumber=int(order_number),
+                orderBookedDate=_to_datetime(order['orderbookeddate']),
+                orderSuffix=int(order['ordersuffix']),
+                orderStatus=status_map.get(order['orderstatus'], order['orderstatus']),  # Map the status using status_map
+                orderContactFullName=order['ordercontactfullname'],
+                contactEmailAddress=order['contactemailaddress'],
+                contactPhone=_to_int(order['contactphone']),
+                shipTo=_to_int(order['shipto']),
+                shipToName=order['shiptoname'],
+                splitOrders=split_order_list,
+                skus=sku_list if options.skus else None,
+                cartons=carton_list if options.cartons else None
+                ))
+
+    return order_list
+
+@timed("assembly")
+def build_order_tree(order_numbers: list, orders: list, skus: list, cartons: list, errors: dict = None, options: TreeOptions = FULL_TREE) -> dict:
+    """
+    builds the nested OrderNumber lists for every node of the split trees
+    below order_numbers in memory from the rows fetched for the whole trees,
+    returns a dict of postsplitordernumber -> list of OrderNumber objects.
+    When errors is given a tree that fails to build is recorded there by
+    root order number instead of raising
+    """
+    # group the rows by the node they belong to so every node only sees its own rows
+    orders_by_number = {}
+    children_by_parent = {}
+    for order in orders:
+        orders_by_number.setdefault(_order_key(order['postsplitordernumber']), []).append(order)
+        parent = _order_key(order['originalordernumber'])
+        if parent is not None:
+            children_by_parent.setdefault(parent, []).append(order)
+
+    # skus and cartons are grouped once by (postsplitordernumber, ordersuffix)
+    # so assembling an order is a lookup instead of a scan over every row
+    skus_by_order = {}
+    for sku in skus:
+        skus_by_order.setdefault((_order_key(sku['postsplitordernumber']), sku['ordersuffix']), []).append(sku)
+
+    cartons_by_order = {}
+    for carton in cartons:
+        cartons_by_order.setdefault((_order_key(carton['postsplitordernumber']), carton['ordersuffix']), []).append(carton)
+
+    built = {}
+    max_depth = 0
+
+    def build(number, path):
+        nonlocal max_depth
+        key = _order_key(number)
+        if key in built:
+            return built[key]
+        max_depth = max(max_depth, len(path) - 1)
+
+        # every row that names this order as its original order is a split
+        # order, a split order with several suffixes is listed once per row
+        if key in children_by_parent:
+            split_order_list = []
+            for child in children_by_parent[key]:
+                child_key = _order_key(child['postsplitordernumber'])
+                if child_key in path:
+                    continue
+                split_order_list.extend(build(child['postsplitordernumber'], path | {child_key}))
+        else:
+            split_order_list = None
+
+        built[key] = _assemble_orders(
+            number,
+            orders_by_number.get(key, []),
+            skus_by_order,
+            cartons_by_order,
+            split_order_list,
+            options
         )
+        return built[key]
 
-        products.append(product)
-    
+    for order_number in order_numbers:
+        try:
+            build(order_number, {_order_key(order_number)})
+        except Exception as e:
+            if errors is None:
+                raise
+            errors[_order_key(order_number)] = e
 
-    return products
+    if built:
+        record_split_depth(max_depth)
+    return built
+
+def invalidate_orders(order_numbers, changed_at = None) -> None:
+    """
+    drops the cached trees of order_numbers, callers include the orders
+    they were split from since those trees embed them. changed_at is the
+    change watermark the orders were found at, materialised rows built
+    before it are not served for them
+    """
+    suffixes = [""] + list(_cached_variants)
+    for number in order_numbers:
+        for suffix in suffixes:
+            order_cache.delete(f"order_{number}{suffix}")
+        if ORDER_TREE_SOURCE == 'materialized' and changed_at is not None:
+            materialized_changes.set(f"order_{_order_key(number)}", _as_utc(changed_at))
+    logger.info(f"Invalidated {len(order_numbers)} cached orders")
+
+def _order_cache_key(order_number, options: TreeOptions = FULL_TREE) -> str:
+    return f"order_{order_number}{options.cache_suffix}"
+
+def order_json_etag(cached: CachedOrders, if_none_match: str = None) -> Tuple[Optional[bytes], str]:
+    """
+    the JSON bytes and ETag of a cached order list. The JSON is None when
+    if_none_match already names the ETag, an unchanged order is then
+    answered without serialising it
+    """
+    etag = cached.etag
+    data = None
+    if etag is None:
+        data = dump_orders(cached.orders)
+        etag = content_etag(data)
+    if etag_matches(if_none_match, etag):
+        return None, etag
+
+    if data is None and ORDER_CACHE_BYTES:
+        data = order_bytes_cache.get(etag)
+    if data is None:
+        data = dump_orders(cached.orders)
+        if ORDER_CACHE_BYTES:
+            order_bytes_cache.set(etag, data)
+    return data, etag
+
+def _cache_order(order_number, order_list: list, options: TreeOptions = FULL_TREE, etag: bool = True) -> CachedOrders:
+    if options != FULL_TREE:
+        _cached_variants.add(options.cache_suffix)
+    if not etag:
+        cached = CachedOrders(order_list)
+        order_cache.set(_order_cache_key(order_number, options), cached)
+        return cached
+
+    data = dump_orders(order_list)
+    cached = CachedOrders(order_list, content_etag(data))
+    order_cache.set(_order_cache_key(order_number, options), cached)
+    if ORDER_CACHE_BYTES:
+        order_bytes_cache.set(cached.etag, data)
+    return cached
+
+def _cache_order_tree(order_number, tree: dict, options: TreeOptions = FULL_TREE) -> CachedOrders:
+    """
+    caches every node of an assembled tree so later lookups of a split
+    order also hit, returns the cache entry of order_number. Only the root
+    gets its ETag, serialising every node would cost nodes x depth. Below
+    a depth limited root the nodes are cut off at a different depth, so
+    only the root is cached then
+    """
+    if options.max_depth is None:
+        for number, order_list in tree.items():
+            if number != _order_key(order_number):
+                _cache_order(number, order_list, options, etag=False)
 
+    return _cache_order(order_number, tree[_order_key(order_number)], options)
 
+def _refresh_order(order_number, sf_engine = sf_engine, options: TreeOptions = FULL_TREE) -> None:
+    # runs on a refresher thread, queued behind every request's queries
+    with admission.blocking_slot("background"), sf_engine().connect() as conn:
+        _resolve_order_trees([order_number], conn, options=options)
 
-def process_order_number(order_number: int, conn) -> list:
+def _cached_order(order_number, sf_engine = sf_engine, options: TreeOptions = FULL_TREE) -> Optional[CachedOrders]:
+    """
+    the cache entry of order_number or None. A stale entry is still
+    returned and refreshed in the background, as is a hot one nearing its TTL
     """
-    recursively creates a list of all the 
-    orders that match the order number, includes all the split orders
-    for which the function is run again until there are no more split
-    orders
+    cache_key = _order_cache_key(order_number, options)
+    cached_result, age = order_cache.lookup(cache_key)
+    if cached_result is None:
+        record_cache("order", "miss")
+        return None
+
+    record_cache("order", "stale" if age >= order_cache.ttl else "hit")
+    hot = order_refresher.touch(cache_key)
+    if age >= order_cache.ttl or (hot and age >= order_cache.ttl * ORDER_REFRESH_AHEAD):
+        order_refresher.submit(cache_key, lambda: _refresh_order(order_number, sf_engine, options))
+    return cached_result
+
+def process_order_number(order_number: int, conn, sf_engine = sf_engine, options: TreeOptions = FULL_TREE) -> CachedOrders:
+    """
+    creates a list of all the orders that match the order number, including
+    all the split orders nested under them, and returns it as cached with
+    its ETag. The whole split tree is fetched with one query per table and
+    assembled in memory, options can leave parts of it out
     """
     # Check cache first
-    cache_key = f"order_{order_number}"
-    cached_result = order_cache.get(cache_key)
+    cached_result = _cached_order(order_number, sf_engine, options)
     if cached_result is not None:
-        print(f"Cache hit for order {order_number}")
+        logger.debug(f"Cache hit for order {order_number}")
         return cached_result
     
-    print(f"Cache miss for order {order_number} - querying database")
-
+    logger.debug(f"Cache miss for order {order_number} - querying database")
 
-    # create an empty list to hold OrderNumber objects
-    order_list = []
+    if ORDER_TREE_SOURCE == 'materialized' and options == FULL_TREE:
+        materialized = get_materialized_tree(order_number, conn)
+        if materialized is not None:
+            return _cache_order(order_number, materialized)
 
     # all order numbers might have multiple orders due to back order levels
     # we will treat all backorder levels as separate orders
+    orders = get_order_tree([order_number], conn, options.max_depth)
+    if not orders:
+        return _cache_order(order_number, [], options)
 
-    orders = get_orders(order_number, conn)
+    order_numbers = sorted({_order_key(order['postsplitordernumber']) for order in orders})
 
-    exists_in_original = check_in_original(order_number, conn)
+    # snowflake query to get all the skus under every order in the tree
+    skus = get_skus(order_numbers, conn) if options.skus else []
 
-    # snowflake query to get all the skus under
-    skus = get_skus(order_number, conn)
+    # query snowflake to get all the cartons under every order in the tree
+    cartons = get_cartons(order_numbers, conn) if options.cartons else []
 
-    # query snowflake to get all the cartons under the postsplitordernumber 
-    cartons = get_cartons(order_number, conn)
-    
-    # iterate through each order that appears under the postsplitordernumber
-    for order in orders:
+    tree = build_order_tree([order_number], orders, skus, cartons, options=options)
+    return _cache_order_tree(order_number, tree, options)
 
-        sku_list = []
-        # for each order get all the skus that are for it
-        for sku in skus:
-            if sku['postsplitordernumber'] == order['postsplitordernumber'] and sku['ordersuffix'] == order['ordersuffix']:
-                pick_qty = None if sku["pickqty"] is None else int(float(sku["pickqty"]))
-                sku_list.append(
-                    Sku(
-                        orderNumber=int(sku["postsplitordernumber"]),
-                        orderSuffix=sku["ordersuffix"],
-                        sku=sku["sku"],
-                        pickQty=pick_qty
-                    )
-                )
+def _resolve_order_trees(order_numbers: list, conn, cache: bool = True, options: TreeOptions = FULL_TREE, etags: dict = None) -> Tuple[dict, dict]:
+    """
+    fetches and assembles the split trees of order_numbers with one query
+    per table on a single connection and caches them unless cache is False.
+    Returns (results, errors) keyed by order number, an order that fails
+    only records its own error. etags, when given, receives the ETag of
+    every order cached
+    """
+    orders = get_order_tree(order_numbers, conn, options.max_depth)
+    order_numbers_in_tree = sorted({_order_key(order['postsplitordernumber']) for order in orders})
+    skus = get_skus(order_numbers_in_tree, conn) if options.skus else []
+    cartons = get_cartons(order_numbers_in_tree, conn) if options.cartons else []
+
+    build_errors = {}
+    tree = build_order_tree(order_numbers, orders, skus, cartons, errors=build_errors, options=options)
+
+    results = {}
+    errors = {}
+    for order_number in order_numbers:
+        key = _order_key(order_number)
+        if key in build_errors:
+            errors[order_number] = build_errors[key]
+        elif not cache:
+            results[order_number] = tree.get(key, [])
+        else:
+            cached = _cache_order_tree(order_number, tree, options) if key in tree else _cache_order(order_number, [], options)
+            results[order_number] = cached.orders
+            if etags is not None:
+                etags[order_number] = cached.etag
 
-        # for each order
-        carton_list = []
+    return results, errors
 
-        # for each carton we add to list of cartons but only if it matches the 
-        for carton in cartons:
-            carton_sku_list = []
-            for sku in skus:
-                if sku['postsplitordernumber'] == carton["postsplitordernumber"] and sku["ordersuffix"] == carton["ordersuffix"]:
-                    pick_qty = None if sku["pickqty"] is None else int(float(sku["pickqty"]))
-                    carton_sku_list.append(
-                        Sku(
-                            orderNumber=sku["postsplitordernumber"],
-                            orderSuffix=sku["ordersuffix"],
-                            sku=sku["sku"],
-                            pickQty=pick_qty
-                        )
-                    )
-
-            if carton['postsplitordernumber'] == order['postsplitordernumber'] and carton['ordersuffix'] == order['ordersuffix']:
-                carton_list.append(
-                    Carton(
-                        orderNumber=carton["postsplitordernumber"],
-                        orderSuffix=carton['ordersuffix'],
-                        cartonId=carton["cartonid"],
-                        deliveryStatusDescription=carton["deliverystatusdescription"],
-                        actualDeliveryDate=carton["actualdeliverydate"],
-                        expectedDeliveryDate=carton["expecteddeliverydate"],
-                        carrierCode=carton["carriercode"],
-                        carrierDescription=carton["carrierdescription"],
-                        traceAndTraceLink=carton["trace_and_trace_link"],
-                        skus=carton_sku_list
-                    )
-                )
+def process_order_numbers(order_numbers: list, conn, sf_engine = sf_engine) -> Tuple[dict, dict]:
+    """
+    resolves the split trees of many order numbers at once, orders in the
+    cache are served from it and the rest share one set of queries
+    """
+    results = {}
+    misses = []
+    for order_number in order_numbers:
+        cached_result = _cached_order(order_number, sf_engine)
+        if cached_result is not None:
+            results[order_number] = cached_result.orders
+        else:
+            misses.append(order_number)
 
-        if exists_in_original:
-            # make snowflake query to query the original order column
-            split_orders = original_order_query(order_number, conn)
-            split_order_list = []
-            for order in split_orders:
-                split_order_list.extend(process_order_number(order['postsplitordernumber'], conn))
+    logger.debug(f"Batch of {len(order_numbers)} orders, {len(misses)} cache misses - querying database")
+
+    if not misses:
+        return results, {}
+
+    resolved, errors = _resolve_order_trees(misses, conn)
+    results.update(resolved)
+    return results, errors
+
+def _root_order_query(ship_to: int = None, booked_from: date = None, booked_to: date = None, after: int = None, limit: int = None) -> Tuple[str, dict]:
+    """
+    the statement and parameters selecting the order numbers at the root of
+    a split tree matching the filters, in order, optionally only those
+    after `after` and at most limit of them
+    """
+    full_table = f"{DB}.{SCHEMA}.{'wismo_orders'}"
+    filters = ["ORIGINALORDERNUMBER IS NULL"]
+    params = {}
+    if ship_to is not None:
+        filters.append("shipto = :ship_to")
+        params["ship_to"] = int(ship_to)
+    if booked_from is not None:
+        filters.append("orderbookeddate >= :booked_from")
+        params["booked_from"] = booked_from.isoformat()
+    if booked_to is not None:
+        # the whole of booked_to is included
+        filters.append("orderbookeddate < :booked_before")
+        params["booked_before"] = (booked_to + timedelta(days=1)).isoformat()
+    if after is not None:
+        filters.append("postsplitordernumber > :after")
+        params["after"] = int(after)
+
+    sql = f"""
+        SELECT DISTINCT postsplitordernumber
+        FROM {full_table}
+        WHERE {" AND ".join(filters)}
+        ORDER BY postsplitordernumber
+    """
+    if limit is not None:
+        sql += "LIMIT :limit"
+        params["limit"] = int(limit)
+    return sql, params
+
+def iter_root_order_numbers(conn, ship_to: int = None, booked_from: date = None, booked_to: date = None, page_size: int = 500) -> Iterator[list]:
+    """
+    yields pages of the order numbers at the root of a split tree (orders
+    that are not a split of another order) matching the filters, read with a
+    server-side cursor so the full result set is never held in memory
+    """
+    sql, params = _root_order_query(ship_to, booked_from, booked_to)
+    result = conn.execution_options(stream_results=True, yield_per=page_size).execute(text(sql), params)
+    for page in result.partitions(page_size):
+        yield [row[0] for row in page]
+
+def _export_page(after, ship_to, booked_from, booked_to, conn) -> Tuple[list, list]:
+    """
+    the next EXPORT_PAGE_SIZE root order numbers after `after` matching the
+    filters and the NDJSON line of each, their trees are not cached
+    """
+    sql, params = _root_order_query(ship_to, booked_from, booked_to, after, EXPORT_PAGE_SIZE)
+    page = [row[0] for row in conn.execute(text(sql), params)]
+    if not page:
+        return page, []
+
+    results, errors = _resolve_order_trees(page, conn, cache=False)
+    lines = []
+    for order_number in page:
+        if order_number in errors:
+            line = {"orderNumber": order_number, "error": str(errors[order_number])}
+            lines.append(json.dumps(line).encode() + b"\n")
         else:
-            split_order_list=None
-        
-        order_list.append(
-            OrderNumber(
-                orderNumber=order_number,
-                orderBookedDate=order['orderbookeddate'],
-                orderSuffix=order['ordersuffix'],
-                orderStatus=status_map.get(order['orderstatus'], order['orderstatus']),  # Map the status using status_map
-                orderContactFullName=order['ordercontactfullname'],
-                contactEmailAddress=order['contactemailaddress'],
-                contactPhone=order['contactphone'],
-                shipTo=order['shipto'],
-                shipToName=order['shiptoname'],
-                splitOrders=split_order_list,
-                skus=sku_list,
-                cartons=carton_list
-                ))
-    # Cache the result
-    order_cache.set(cache_key, order_list)    
-    return order_list
+            lines.append(b'{"orderNumber":%d,"orders":%s}\n' % (order_number, dump_orders(results[order_number])))
+    return page, lines
 
-def run(order_number, sf_engine = sf_engine):
-    with sf_engine().connect() as conn:
-        order_data = process_order_number(order_number, conn)
+async def export_orders(ship_to: int = None, booked_from: date = None, booked_to: date = None, sf_engine = sf_engine) -> AsyncIterator[bytes]:
+    """
+    streams the order trees of every root order matching the filters as
+    NDJSON, one {"orderNumber": ..., "orders": [...]} line per root order.
+    Trees are resolved a page at a time and not cached, so memory stays
+    flat however many orders match. Each page is read after the last order
+    number of the one before and takes its own admission slot and pooled
+    connection, so an export queues in its lane like any other query and
+    holds no connection between pages. When a later page is not admitted
+    the stream ends with an {"error": ...} line
+    """
+    after = None
+    while True:
+        try:
+            page, lines = await _run_query(sf_engine, _export_page, after, ship_to, booked_from, booked_to)
+        except Overloaded as e:
+            if after is None:
+                raise
+            yield json.dumps({"error": str(e)}).encode() + b"\n"
+            return
+
+        for line in lines:
+            yield line
+        if len(page) < EXPORT_PAGE_SIZE:
+            return
+        after = page[-1]
+
+async def _run_query(sf_engine, query, *args):
+    """
+    runs query(*args, conn) on the query executor with its own pooled
+    connection so independent queries can run at the same time. The
+    request context goes along so the query is counted against it. Raises
+    Overloaded when no admission slot frees up in time
+    """
+    def execute():
+        with sf_engine().connect() as conn:
+            return query(*args, conn)
+
+    loop = asyncio.get_running_loop()
+    async with admission.slot():
+        return await loop.run_in_executor(query_executor, contextvars.copy_context().run, execute)
+
+async def _order_cache_io(fn, *args):
+    """
+    runs fn(*args), a lookup or write of the order cache, in a worker thread
+    unless the cache is kept in memory. The shared backends do I/O and
+    decode whole trees, which would hold up the event loop
+    """
+    if order_cache.backend.name == "memory":
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+async def process_order_number_async(order_number: int, sf_engine = sf_engine, options: TreeOptions = FULL_TREE) -> CachedOrders:
+    """
+    async version of process_order_number, the sku and carton queries of
+    the tree run concurrently on separate connections
+    """
+    cached_result = await _order_cache_io(_cached_order, order_number, sf_engine, options)
+    if cached_result is not None:
+        logger.debug(f"Cache hit for order {order_number}")
+        return cached_result
+
+    logger.debug(f"Cache miss for order {order_number} - querying database")
+
+    if ORDER_TREE_SOURCE == 'materialized' and options == FULL_TREE:
+        materialized = await _run_query(sf_engine, get_materialized_tree, order_number)
+        if materialized is not None:
+            return await _order_cache_io(_cache_order, order_number, materialized)
+
+    orders = await _run_query(sf_engine, partial(get_order_tree, max_depth=options.max_depth), [order_number])
+    if not orders:
+        return await _order_cache_io(_cache_order, order_number, [], options)
+
+    order_numbers = sorted({_order_key(order['postsplitordernumber']) for order in orders})
+
+    async def no_rows():
+        return []
+
+    skus, cartons = await asyncio.gather(
+        _run_query(sf_engine, get_skus, order_numbers) if options.skus else no_rows(),
+        _run_query(sf_engine, get_cartons, order_numbers) if options.cartons else no_rows()
+    )
+
+    # assembling and caching a large tree is CPU bound, keep it off the event loop
+    def build():
+        tree = build_order_tree([order_number], orders, skus, cartons, options=options)
+        return _cache_order_tree(order_number, tree, options)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(query_executor, contextvars.copy_context().run, build)
+
+def run(order_number, sf_engine = sf_engine, options: TreeOptions = FULL_TREE):
+    def fetch():
+        with sf_engine().connect() as conn:
+            return process_order_number(order_number, conn, sf_engine, options)
+
+    # concurrent requests for the same order share a single fetch
+    order_data = order_flight.do(_order_cache_key(order_number, options), fetch)
     return order_data
 
 def run_get_products(skus: list, sf_engine = sf_engine):
-    try:
+    if product_catalog is not None and product_catalog.ready():
+        return product_catalog.lookup(skus)
+
+    def fetch(misses):
         with sf_engine().connect() as conn:
-            product_data = get_products(skus, conn)
-        return product_data
+            return fetch_products(misses, conn)
+
+    try:
+        # only the fetch of the missing skus is shared, every caller gets
+        # the products back in its own request order
+        products, misses = _cached_products(skus)
+        if misses:
+            products.update(product_flight.do("products_" + ",".join(sorted(misses)), lambda: fetch(misses)))
+        return _in_request_order(skus, products)
     except Exception as e:
-        print(f"Error in run_get_products: {e}")
-        raise Exception(f"Failed to get products: {str(e)}")
\ No newline at end of file
+        logger.error(f"Error in run_get_products: {e}")
+        raise Exception(f"Failed to get products: {str(e)}")
+
+async def run_async(order_number, sf_engine = sf_engine, options: TreeOptions = FULL_TREE):
+    # concurrent requests for the same order share a single fetch
+    return await async_order_flight.do(
+        _order_cache_key(order_number, options),
+        lambda: process_order_number_async(order_number, sf_engine, options)
+    )
+
+async def run_get_products_async(skus: list, sf_engine = sf_engine):
+    if product_catalog is not None and product_catalog.ready():
+        return product_catalog.lookup(skus)
+
+    try:
+        # only the fetch of the missing skus is shared, every caller gets
+        # the products back in its own request order
+        products, misses = _cached_products(skus)
+        if misses:
+            products.update(await async_product_flight.do(
+                "products_" + ",".join(sorted(misses)),
+                lambda: _run_query(sf_engine, fetch_products, misses)
+            ))
+        return _in_request_order(skus, products)
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Error in run_get_products_async: {e}")
+        raise Exception(f"Failed to get products: {str(e)}")
+
+async def run_batch_async(order_numbers: list, sf_engine = sf_engine) -> dict:
+    """
+    looks up many orders at once, returns a dict of order number ->
+    {"orders": [...], "etag": "..."} or {"error": "..."} so one bad order
+    doesn't fail the batch
+    """
+    if len(order_numbers) > BATCH_MAX_ORDERS:
+        raise ValueError(f"A batch can hold at most {BATCH_MAX_ORDERS} order numbers")
+
+    results = {}
+    misses = []
+
+    def lookup():
+        for order_number in dict.fromkeys(order_numbers):
+            try:
+                _order_key(order_number)
+            except (TypeError, ValueError):
+                results[order_number] = {"error": "Invalid order number"}
+                continue
+
+            cached_result = _cached_order(order_number, sf_engine)
+            if cached_result is not None:
+                results[order_number] = {"orders": cached_result.orders, "etag": cached_result.etag}
+            else:
+                misses.append(order_number)
+
+    await _order_cache_io(lookup)
+
+    logger.debug(f"Batch of {len(order_numbers)} orders, {len(misses)} cache misses - querying database")
+
+    # each chunk shares one connection and runs a fixed number of queries
+    chunks = [misses[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(misses), BATCH_CHUNK_SIZE)]
+    etags = {}
+    outcomes = await asyncio.gather(
+        *[_run_query(sf_engine, partial(_resolve_order_trees, etags=etags), chunk) for chunk in chunks],
+        return_exceptions=True
+    )
+
+    for chunk, outcome in zip(chunks, outcomes):
+        # the chunks that did run are cached, a retry only waits for the rest
+        if isinstance(outcome, Overloaded):
+            raise outcome
+        if isinstance(outcome, Exception):
+            logger.error(f"Error in run_batch_async: {outcome}")
+            for order_number in chunk:
+                results[order_number] = {"error": str(outcome)}
+            continue
+
+        chunk_results, chunk_errors = outcome
+        for order_number in chunk:
+            if order_number in chunk_errors:
+                results[order_number] = {"error": str(chunk_errors[order_number])}
+            else:
+                results[order_number] = {"orders": chunk_results[order_number], "etag": etags[order_number]}
+
+    return results
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from sqlalchemy import text
+
+from utils import queries
+from utils.connections import DB, SCHEMA
+
+logger = logging.getLogger(__name__)
+
+# CHANGE_DETECTION=true polls the wismo tables for changed rows and drops
+# the cached trees they belong to, which allows a much longer order cache TTL
+CHANGE_DETECTION = os.getenv('CHANGE_DETECTION', 'false').lower() == 'true'
+CHANGE_POLL_INTERVAL = float(os.getenv('CHANGE_POLL_INTERVAL', 60))
+# column on every wismo table that is set when the row is written
+CHANGE_WATERMARK_COLUMN = os.getenv('CHANGE_WATERMARK_COLUMN', 'updated_at')
+
+WATCHED_TABLES = ("wismo_orders", "wismo_cartons", "wismo_skus")
+
+# guards the ancestor query against cycles in ORIGINALORDERNUMBER
+MAX_ANCESTOR_DEPTH = 50
+
+
+def get_ancestors(order_numbers: Iterable[int], conn) -> Set[int]:
+    """
+    Every order that order_numbers were split from, directly or through
+    other split orders, found by walking ORIGINALORDERNUMBER upwards.
+    """
+    numbers = [int(number) for number in order_numbers]
+    if not numbers:
+        return set()
+
+    params = {"numbers": queries.pad_values(numbers), "depth_limit": MAX_ANCESTOR_DEPTH}
+    return {int(row[0]) for row in conn.execute(queries.ANCESTORS, params)}
+
+
+class ChangeWatcher:
+    """
+    Polls the wismo tables for rows whose watermark column moved past the
+    last value seen and calls on_change with the order numbers affected,
+    including every order they were split from, since those trees embed
+    them. The first poll only records the current watermarks.
+    """
+
+    def __init__(
+        self,
+        engine: Callable,
+        on_change: Callable[[Set[int]], Any],
+        interval: float = CHANGE_POLL_INTERVAL,
+        column: str = CHANGE_WATERMARK_COLUMN,
+        tables: Iterable[str] = WATCHED_TABLES,
+    ):
+        self.engine = engine
+        self.on_change = on_change
+        self.interval = interval
+        self.column = column
+        self.tables = tuple(tables)
+        self.watermarks: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+        self.polls = 0
+        self.changed_orders = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def poll(self) -> Set[int]:
+        """Check every table once, returns the order numbers invalidated."""
+        changed: Set[int] = set()
+        with self.engine().connect() as conn:
+            for table in self.tables:
+                changed |= self._changed_in(table, conn)
+            if changed:
+                changed |= get_ancestors(changed, conn)
+
+        if changed:
+            self.on_change(changed)
+        with self.lock:
+            self.polls += 1
+            self.changed_orders += len(changed)
+        return changed
+
+    def _changed_in(self, table: str, conn) -> Set[int]:
+        full_table = f"{DB}.{SCHEMA}.{table}"
+        watermark = self.watermarks.get(table)
+
+        if watermark is None:
+            sql = f"SELECT MAX({self.column}) FROM {full_table}"
+            self.watermarks[table] = conn.execute(text(sql)).scalar()
+            return set()
+
+        sql = f"""
+            SELECT postsplitordernumber, MAX({self.column}) AS changed_at
+            FROM {full_table}
+            WHERE {self.column} > :watermark
+            GROUP BY postsplitordernumber
+        """
+        rows = conn.execute(text(sql), {"watermark": watermark}).fetchall()
+        if rows:
+            self.watermarks[table] = max(row[1] for row in rows)
+        return {int(row[0]) for row in rows}
+
+    def watermark(self) -> Any:
+        """The latest change seen in any table, None before the first poll."""
+        values = [value for value in self.watermarks.values() if value is not None]
+        return max(values) if values else None
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "polls": self.polls,
+                "changed_orders": self.changed_orders,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "watermarks": {table: str(value) for table, value in self.watermarks.items()},
+            }
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="change-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                    self.last_error = str(e)
+                logger.error(f"Change detection poll failed: {e}")
+            if self._stop.wait(self.interval):
+                return
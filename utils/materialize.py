@@ -0,0 +1,195 @@
+"""
+Keeps a precomputed copy of every order tree in ORDER_TREE_TABLE, one row
+per order number holding the JSON of its full order list, so the API can
+serve a tree with a single row lookup (ORDER_TREE_SOURCE=materialized).
+
+    python -m utils.materialize --full     rebuild every tree
+    python -m utils.materialize            rebuild the trees changed since the last run
+    python -m utils.materialize --watch    keep rebuilding changed trees every CHANGE_POLL_INTERVAL
+
+Run it after the Dagster jobs that load the wismo tables, or call
+build_all() and update_changed() from an asset downstream of them. Changes
+are found like the API's change detection, through the watermark column
+of the wismo tables, and the watermarks reached are kept in
+ORDER_TREE_TABLE_watermarks between runs. Orders deleted upstream keep
+their rows until the next full build.
+"""
+import argparse
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Iterable
+
+from sqlalchemy import bindparam, text
+
+from utils import helper, queries
+from utils.connections import sf_engine
+from utils.invalidation import CHANGE_POLL_INTERVAL, ChangeWatcher
+from utils.serialization import dump_orders
+
+logger = logging.getLogger(__name__)
+
+WATERMARKS_TABLE = f"{queries.TREES_TABLE}_watermarks"
+
+# VARCHAR rather than VARIANT so the row is sent back as the exact JSON the
+# API serves, both hold up to 16MB
+CREATE_SQL = (
+    f"""
+    CREATE TABLE IF NOT EXISTS {queries.TREES_TABLE} (
+        postsplitordernumber NUMBER,
+        tree VARCHAR,
+        built_at TIMESTAMP
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS {WATERMARKS_TABLE} (
+        table_name VARCHAR,
+        watermark VARCHAR
+    )
+    """,
+)
+
+DELETE_TREES = text(f"""
+    DELETE FROM {queries.TREES_TABLE}
+    WHERE postsplitordernumber IN :numbers
+""").bindparams(bindparam("numbers", expanding=True))
+
+INSERT_TREE = text(f"""
+    INSERT INTO {queries.TREES_TABLE} (postsplitordernumber, tree, built_at)
+    VALUES (:number, :tree, :built_at)
+""")
+
+
+def create_tables(engine) -> None:
+    with engine.begin() as conn:
+        for sql in CREATE_SQL:
+            conn.execute(text(sql))
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=" ")
+
+
+def write_trees(order_numbers: Iterable[int], conn, engine) -> int:
+    """
+    Assembles the split trees below order_numbers and replaces the row of
+    every order in them, returns the number of rows written. A tree that
+    fails to build is logged and left as it was.
+    """
+    order_numbers = list(order_numbers)
+    if not order_numbers:
+        return 0
+
+    orders = helper.get_order_tree(order_numbers, conn)
+    numbers_in_tree = sorted({helper._order_key(order['postsplitordernumber']) for order in orders})
+    skus = helper.get_skus(numbers_in_tree, conn) if numbers_in_tree else []
+    cartons = helper.get_cartons(numbers_in_tree, conn) if numbers_in_tree else []
+
+    errors = {}
+    tree = helper.build_order_tree(order_numbers, orders, skus, cartons, errors=errors)
+    for number, error in errors.items():
+        logger.error(f"Failed to build the tree of order {number}: {error}")
+    if not tree:
+        return 0
+
+    built_at = _now()
+    rows = [
+        {"number": number, "tree": dump_orders(order_list).decode(), "built_at": built_at}
+        for number, order_list in tree.items()
+    ]
+    with engine.begin() as write_conn:
+        write_conn.execute(DELETE_TREES, {"numbers": list(tree)})
+        write_conn.execute(INSERT_TREE, rows)
+    return len(rows)
+
+
+def _load_watermarks(engine) -> dict:
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT table_name, watermark FROM {WATERMARKS_TABLE}")).fetchall()
+    return {table: watermark for table, watermark in rows if watermark is not None}
+
+
+def _save_watermarks(engine, watermarks: dict) -> None:
+    rows = [{"table": table, "watermark": str(watermark)} for table, watermark in watermarks.items() if watermark is not None]
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {WATERMARKS_TABLE}"))
+        if rows:
+            conn.execute(text(f"INSERT INTO {WATERMARKS_TABLE} (table_name, watermark) VALUES (:table, :watermark)"), rows)
+
+
+def build_all(sf_engine = sf_engine, page_size: int = helper.EXPORT_PAGE_SIZE) -> int:
+    """
+    Rebuilds the tree of every order and drops the rows of orders that are
+    gone, returns the number of rows written. The watermarks are recorded
+    before reading so changes made during the build are picked up by the
+    next update_changed().
+    """
+    engine = sf_engine()
+    create_tables(engine)
+
+    watcher = ChangeWatcher(lambda: engine, on_change=lambda changed: None)
+    watcher.poll()
+    started = _now()
+
+    written = 0
+    with engine.connect() as cursor_conn, engine.connect() as conn:
+        for page in helper.iter_root_order_numbers(cursor_conn, page_size=page_size):
+            written += write_trees(page, conn, engine)
+            logger.info(f"Materialised {written} order trees")
+
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {queries.TREES_TABLE} WHERE built_at < :started"), {"started": started})
+    _save_watermarks(engine, watcher.watermarks)
+    return written
+
+
+def update_changed(sf_engine = sf_engine) -> int:
+    """
+    Rebuilds the trees of the orders changed since the watermarks were last
+    saved, and of every order they were split from, returns the number of
+    rows written. Without saved watermarks nothing is known to have changed
+    yet, run build_all() first.
+    """
+    engine = sf_engine()
+    create_tables(engine)
+    written = 0
+
+    def rebuild(changed):
+        nonlocal written
+        with engine.connect() as conn:
+            changed = sorted(changed)
+            for start in range(0, len(changed), helper.EXPORT_PAGE_SIZE):
+                written += write_trees(changed[start:start + helper.EXPORT_PAGE_SIZE], conn, engine)
+
+    watcher = ChangeWatcher(lambda: engine, on_change=rebuild)
+    watcher.watermarks = _load_watermarks(engine)
+    watcher.poll()
+    _save_watermarks(engine, watcher.watermarks)
+    if written:
+        logger.info(f"Materialised {written} changed order trees")
+    return written
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--full", action="store_true", help="rebuild every tree")
+    parser.add_argument("--watch", action="store_true", help="keep rebuilding changed trees")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.full:
+        logger.info(f"Built {build_all()} order trees")
+    else:
+        update_changed()
+
+    if args.watch:
+        while True:
+            time.sleep(CHANGE_POLL_INTERVAL)
+            try:
+                update_changed()
+            except Exception as e:
+                logger.error(f"Failed to update the order trees: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# SERVER_TIMING=true adds a Server-Timing header with the stage timings of
+# each request, handy in the browser devtools but it exposes query names
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() == 'true'
+
+# seconds, from a cached lookup up to a slow warehouse query
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """A named metric with a fixed set of label names, rendered in the Prometheus text format."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self._samples()
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (count per bucket, sum, count)
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def _samples(self) -> Iterator[str]:
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        for key, counts, total, count in values:
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{labels} {bucket_count}"
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+class Registry:
+    """The metrics served on /metrics."""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.register(Histogram(
+    "wismo_request_seconds", "Time to handle a request", ("route", "status")
+))
+stage_seconds = registry.register(Histogram(
+    "wismo_stage_seconds", "Time spent in each query function and in assembly", ("stage",)
+))
+queries_total = registry.register(Counter(
+    "wismo_queries_total", "Snowflake queries run", ("query",)
+))
+query_errors_total = registry.register(Counter(
+    "wismo_query_errors_total", "Snowflake queries that raised", ("query",)
+))
+queries_per_request = registry.register(Histogram(
+    "wismo_queries_per_request", "Snowflake queries run per request", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100)
+))
+cache_lookups_total = registry.register(Counter(
+    "wismo_cache_lookups_total", "Cache lookups by cache and result", ("cache", "result")
+))
+split_depth = registry.register(Histogram(
+    "wismo_split_depth", "Depth of the split order trees built",
+    buckets=(0, 1, 2, 3, 4, 5, 10, 25, 50)
+))
+cache_entries = registry.register(Gauge(
+    "wismo_cache_entries", "Entries held by each cache", ("cache",)
+))
+pool_checked_out = registry.register(Gauge(
+    "wismo_pool_checked_out", "Snowflake connections checked out of the pool"
+))
+
+
+class RequestStats:
+    """What a single request spent its time on, shared by every task and thread working on it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+        self.queries = 0
+        self.cache: Dict[str, int] = {}
+        self.split_depth: Optional[int] = None
+
+    def add_stage(self, stage: str, seconds: float, query: bool) -> None:
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+            if query:
+                self.queries += 1
+
+    def server_timing(self, total: float) -> str:
+        with self.lock:
+            entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+            entries.append(f'queries;desc="{self.queries}"')
+            entries.extend(f'cache-{result};desc="{count}"' for result, count in self.cache.items())
+            if self.split_depth is not None:
+                entries.append(f'split-depth;desc="{self.split_depth}"')
+        entries.append(f"total;dur={total * 1000:.1f}")
+        return ", ".join(entries)
+
+
+# the stats of the request being handled, copied into the executor threads
+# by helper._run_query so queries are counted against their request
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+def start_request() -> Tuple[RequestStats, contextvars.Token]:
+    stats = RequestStats()
+    return stats, current_request.set(stats)
+
+
+def end_request(token: contextvars.Token, stats: RequestStats, route: str, status: int, seconds: float) -> None:
+    current_request.reset(token)
+    request_seconds.observe(seconds, route=route, status=status)
+    queries_per_request.observe(stats.queries, route=route)
+
+
+@contextmanager
+def timed(stage: str, query: bool = False):
+    """Time the block as stage, query=True also counts it as a Snowflake query."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        if query:
+            query_errors_total.inc(query=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, stage=stage)
+        if query:
+            queries_total.inc(query=stage)
+        stats = current_request.get()
+        if stats is not None:
+            stats.add_stage(stage, seconds, query)
+
+
+def timed_query(fn):
+    """Decorator timing every call of a query function under its name."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with timed(fn.__name__, query=True):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def record_cache(cache: str, result: str) -> None:
+    """Count a lookup of cache, result is hit, miss or stale."""
+    cache_lookups_total.inc(cache=cache, result=result)
+    stats = current_request.get()
+    if stats is not None:
+        with stats.lock:
+            key = f"{cache}-{result}"
+            stats.cache[key] = stats.cache.get(key, 0) + 1
+
+
+def record_split_depth(depth: int) -> None:
+    split_depth.observe(depth)
+    stats = current_request.get()
+    if stats is not None:
+        with stats.lock:
+            stats.split_depth = max(depth, stats.split_depth or 0)
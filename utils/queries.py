@@ -0,0 +1,264 @@
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import bindparam, event, text
+from sqlalchemy.engine import Engine
+
+from utils.connections import DB, SCHEMA, SF_QUERY_TAG
+from utils.metrics import Counter, Gauge, Histogram, registry
+
+logger = logging.getLogger(__name__)
+
+# how often Snowflake's query history is read for compilation times and
+# result cache reuse, off by default since every read wakes the warehouse.
+# One worker per host reads it, the one holding SF_QUERY_HISTORY_LOCK
+SF_QUERY_HISTORY_INTERVAL = float(os.getenv('SF_QUERY_HISTORY_INTERVAL', 0))
+SF_QUERY_HISTORY_LOCK = os.getenv('SF_QUERY_HISTORY_LOCK', 'wismo_query_history.lock')
+
+# IN lists are padded up to the next of these sizes so a lookup of 3 or of
+# 7 order numbers runs the same statement text, larger lists round up to a
+# multiple of the largest size
+IN_LIST_SIZES = (1, 4, 16, 64, 256, 1024)
+
+# the precomputed order trees written by utils.materialize
+ORDER_TREE_TABLE = os.getenv('ORDER_TREE_TABLE', 'wismo_order_trees')
+
+ORDERS_TABLE = f"{DB}.{SCHEMA}.{'wismo_orders'}"
+SKUS_TABLE = f"{DB}.{SCHEMA}.{'wismo_skus'}"
+CARTONS_TABLE = f"{DB}.{SCHEMA}.{'wismo_cartons'}"
+PRODUCTS_TABLE = f"{DB}.{SCHEMA}.{'wismo_products'}"
+TREES_TABLE = f"{DB}.{SCHEMA}.{ORDER_TREE_TABLE}"
+
+
+def pad_values(values: list) -> list:
+    """
+    values padded to a stable IN list size by repeating the last one, the
+    repeats don't change what the IN matches
+    """
+    values = list(values)
+    count = len(values)
+    size = next((size for size in IN_LIST_SIZES if size >= count), None)
+    if size is None:
+        step = IN_LIST_SIZES[-1]
+        size = -(-count // step) * step
+    return values + values[-1:] * (size - count)
+
+
+def _in_list(sql: str, *names: str):
+    """A text() statement whose names are bound as expanding IN lists."""
+    return text(sql).bindparams(*(bindparam(name, expanding=True) for name in names))
+
+
+# the split trees below :numbers, walking ORIGINALORDERNUMBER at most :depth_limit levels
+ORDER_TREE = _in_list(f"""
+    WITH RECURSIVE split_tree (postsplitordernumber, depth) AS (
+        SELECT DISTINCT postsplitordernumber, 0
+        FROM {ORDERS_TABLE}
+        WHERE postsplitordernumber IN :numbers
+        UNION ALL
+        SELECT child.postsplitordernumber, parent.depth + 1
+        FROM (
+            SELECT DISTINCT postsplitordernumber, ORIGINALORDERNUMBER
+            FROM {ORDERS_TABLE}
+        ) child
+        JOIN split_tree parent
+            ON child.ORIGINALORDERNUMBER = parent.postsplitordernumber
+        WHERE parent.depth < :depth_limit
+    )
+    SELECT *
+    FROM {ORDERS_TABLE}
+    WHERE postsplitordernumber IN (SELECT postsplitordernumber FROM split_tree)
+""", "numbers")
+
+SKUS = _in_list(f"""
+    SELECT *
+    FROM {SKUS_TABLE}
+    WHERE postsplitordernumber IN :numbers
+""", "numbers")
+
+CARTONS = _in_list(f"""
+    SELECT *
+    FROM {CARTONS_TABLE}
+    WHERE postsplitordernumber IN :numbers
+""", "numbers")
+
+PRODUCTS = _in_list(f"""
+    SELECT *
+    FROM {PRODUCTS_TABLE}
+    WHERE PROD_SKU IN :skus
+""", "skus")
+
+# the precomputed tree of one order, as the JSON of its order list
+MATERIALIZED_TREE = text(f"""
+    SELECT tree, built_at
+    FROM {TREES_TABLE}
+    WHERE postsplitordernumber = :number
+""")
+
+# every order the orders in :numbers were split from
+ANCESTORS = _in_list(f"""
+    WITH RECURSIVE ancestors (postsplitordernumber, depth) AS (
+        SELECT DISTINCT ORIGINALORDERNUMBER, 1
+        FROM {ORDERS_TABLE}
+        WHERE postsplitordernumber IN :numbers
+            AND ORIGINALORDERNUMBER IS NOT NULL
+        UNION ALL
+        SELECT parent.ORIGINALORDERNUMBER, child.depth + 1
+        FROM (
+            SELECT DISTINCT postsplitordernumber, ORIGINALORDERNUMBER
+            FROM {ORDERS_TABLE}
+        ) parent
+        JOIN ancestors child
+            ON parent.postsplitordernumber = child.postsplitordernumber
+        WHERE parent.ORIGINALORDERNUMBER IS NOT NULL
+            AND child.depth < :depth_limit
+    )
+    SELECT DISTINCT postsplitordernumber FROM ancestors
+""", "numbers")
+
+
+statement_cache_total = registry.register(Counter(
+    "wismo_statement_cache_total", "Statements by SQLAlchemy compiled cache result", ("result",)
+))
+statement_texts = registry.register(Gauge(
+    "wismo_statement_texts", "Distinct statement texts sent to the database"
+))
+sf_compilation_seconds = registry.register(Histogram(
+    "wismo_sf_compilation_seconds", "Snowflake compilation time of the service's queries",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+))
+sf_result_cache_total = registry.register(Counter(
+    "wismo_sf_result_cache_total", "Snowflake queries answered from the result cache or executed", ("result",)
+))
+
+# hashes of the statement texts seen, capped so a runaway caller can't grow it forever
+_seen_statements = set()
+MAX_SEEN_STATEMENTS = 10000
+
+# the Snowflake sessions this process has opened, oldest first, the query
+# history is read for these only
+_sessions = {}
+MAX_SESSIONS = 1000
+
+
+@event.listens_for(Engine, "connect")
+def _track_session(dbapi_connection, connection_record):
+    session_id = getattr(dbapi_connection, "session_id", None)
+    if session_id is None:
+        return
+    _sessions[session_id] = None
+    if len(_sessions) > MAX_SESSIONS:
+        del _sessions[next(iter(_sessions))]
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _track_statement(conn, cursor, statement, parameters, context, executemany):
+    cache_hit = getattr(context, "cache_hit", None)
+    if cache_hit is not None:
+        statement_cache_total.inc(result=str(cache_hit).rsplit(".", 1)[-1].lower())
+
+    if len(_seen_statements) < MAX_SEEN_STATEMENTS:
+        _seen_statements.add(hashlib.blake2b(statement.encode(), digest_size=8).digest())
+        statement_texts.set(len(_seen_statements))
+
+
+class QueryHistoryCollector:
+    """
+    Reads Snowflake's query history for the queries tagged SF_QUERY_TAG
+    and records their compilation time and whether the result cache
+    answered them. Snowflake has no reuse flag in the history, a query that
+    scanned no bytes in no execution time is counted as a result cache hit.
+
+    Only the worker holding the lock file polls, and only for the sessions
+    it opened itself. The figures are a sample of the service's queries in
+    which no query is counted twice, however many workers and hosts run.
+    """
+
+    def __init__(self, engine, interval: float = SF_QUERY_HISTORY_INTERVAL, tag: str = SF_QUERY_TAG, lock_path: str = SF_QUERY_HISTORY_LOCK):
+        self.engine = engine
+        self.interval = interval
+        self.tag = tag
+        self.lock_path = lock_path
+        self.since = datetime.now(timezone.utc)
+        self.queries = 0
+        self.reused = 0
+        self._lock = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def poll(self) -> int:
+        engine = self.engine()
+        sessions = list(_sessions)
+        if engine.dialect.name != "snowflake" or not sessions:
+            return 0
+
+        # every poll starts just after the last query the previous one saw,
+        # the poll itself carries the tag too and is left out
+        sql = text("""
+            SELECT compilation_time, execution_time, bytes_scanned, end_time
+            FROM TABLE(INFORMATION_SCHEMA.QUERY_HISTORY_BY_USER(
+                END_TIME_RANGE_START => :since, RESULT_LIMIT => 10000))
+            WHERE query_tag = :tag
+                AND session_id IN :sessions
+                AND execution_status = 'SUCCESS'
+                AND query_text NOT ILIKE '%QUERY_HISTORY_BY_USER%'
+            ORDER BY end_time
+        """).bindparams(bindparam("sessions", expanding=True))
+        with engine.connect() as conn:
+            rows = conn.execute(sql, {"since": self.since, "tag": self.tag, "sessions": sessions}).fetchall()
+
+        for compilation_ms, execution_ms, bytes_scanned, end_time in rows:
+            sf_compilation_seconds.observe((compilation_ms or 0) / 1000)
+            reused = not bytes_scanned and not execution_ms
+            sf_result_cache_total.inc(result="reused" if reused else "executed")
+            self.reused += reused
+        if rows:
+            self.since = rows[-1][3] + timedelta(microseconds=1)
+        self.queries += len(rows)
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "queries": self.queries,
+            "result_cache_hit_rate": self.reused / self.queries if self.queries else None,
+            "statement_texts": len(_seen_statements),
+        }
+
+    def start(self) -> None:
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="query-history", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def _leading(self) -> bool:
+        """Whether this worker polls, the first to take the lock keeps it until it stops."""
+        if self._lock is not None:
+            return True
+        lock = open(self.lock_path, "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False  # another worker is polling
+        self._lock = lock
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                if self._leading():
+                    self.poll()
+            except Exception as e:
+                logger.warning(f"Query history poll failed: {e}")
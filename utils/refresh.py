@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRefresher:
+    """
+    Refreshes cache entries in the background so requests never wait on
+    them. At most max_concurrent refreshes run at once and a key is only
+    refreshed once at a time, a refresh asked for while every slot is busy
+    is dropped and the next request for the key asks again.
+
+    It also counts accesses per key to tell which keys are hot, the counts
+    are halved every hot_window seconds so keys that stop being requested
+    cool down.
+    """
+
+    def __init__(self, max_concurrent: int = 2, hot_hits: int = 10, hot_window: float = 300):
+        self.max_concurrent = max_concurrent
+        self.hot_hits = hot_hits
+        self.hot_window = hot_window
+        self.lock = threading.Lock()
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+        self.accesses: Dict[str, float] = {}
+        self.in_flight: Set[str] = set()
+        self._decayed_at = time.monotonic()
+
+        self.refreshes = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def touch(self, key: str) -> bool:
+        """Record an access to key, returns True if the key is hot."""
+        now = time.monotonic()
+        with self.lock:
+            if now - self._decayed_at >= self.hot_window:
+                self._decay()
+                self._decayed_at = now
+            count = self.accesses.get(key, 0) + 1
+            self.accesses[key] = count
+        return count >= self.hot_hits
+
+    def submit(self, key: str, fn: Callable[[], Any]) -> bool:
+        """Run fn in the background unless key is already being refreshed or no slot is free."""
+        with self.lock:
+            if key in self.in_flight:
+                return False
+            if len(self.in_flight) >= self.max_concurrent:
+                self.dropped += 1
+                return False
+            self.in_flight.add(key)
+            self.refreshes += 1
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrent, thread_name_prefix="cache-refresh"
+                )
+
+        self.executor.submit(self._refresh, key, fn)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "in_flight": len(self.in_flight),
+                "max_concurrent": self.max_concurrent,
+                "refreshes": self.refreshes,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "hot_keys": sum(1 for count in self.accesses.values() if count >= self.hot_hits),
+            }
+
+    def shutdown(self) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _refresh(self, key: str, fn: Callable[[], Any]) -> None:
+        try:
+            fn()
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            logger.error(f"Background refresh of {key} failed: {e}")
+        finally:
+            with self.lock:
+                self.in_flight.discard(key)
+
+    def _decay(self) -> None:
+        # called with the lock held
+        self.accesses = {
+            key: count / 2 for key, count in self.accesses.items() if count >= 2
+        }
@@ -0,0 +1,290 @@
+import fcntl
+import logging
+import os
+import threading
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Optional
+
+from sqlalchemy import create_engine, event, text
+
+from utils.connections import DB, SCHEMA
+from utils.invalidation import CHANGE_WATERMARK_COLUMN, WATCHED_TABLES
+
+logger = logging.getLogger(__name__)
+
+# DATA_SOURCE=replica answers order and product lookups from a local copy of
+# the wismo tables that is synced from Snowflake every REPLICA_SYNC_INTERVAL
+# seconds, until the first sync has finished lookups still go to Snowflake
+DATA_SOURCE = os.getenv('DATA_SOURCE', 'snowflake')
+# any SQLAlchemy url, a duckdb:/// url works where duckdb_engine is installed
+REPLICA_URL = os.getenv('REPLICA_URL', 'sqlite:///wismo_replica.sqlite')
+REPLICA_SYNC_INTERVAL = float(os.getenv('REPLICA_SYNC_INTERVAL', 300))
+# wismo_products has no watermark column, it is copied in full this often
+REPLICA_PRODUCT_REFRESH = float(os.getenv('REPLICA_PRODUCT_REFRESH', 3600))
+
+# the columns each copied table is indexed on
+REPLICA_TABLES = {
+    "wismo_orders": ("postsplitordernumber", "originalordernumber"),
+    "wismo_skus": ("postsplitordernumber",),
+    "wismo_cartons": ("postsplitordernumber",),
+    "wismo_products": ("prod_sku",),
+}
+
+# changed orders are copied this many at a time
+REPLICA_CHUNK_SIZE = 1000
+
+
+def _local_value(value):
+    # types the local drivers can't bind are stored the way they read back
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def _insert(table: str, columns: list):
+    return text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(':' + column for column in columns)})")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class Replica:
+    """
+    A local copy of the wismo tables that the helpers can query in place
+    of Snowflake. The first sync copies every table, later syncs copy only
+    the orders whose rows moved past the watermark column, so a sync takes
+    as long as the changes do. Each table is replaced in one transaction,
+    readers keep seeing the previous copy until it commits.
+
+    Every worker runs the sync loop, a file lock lets one of them sync at a
+    time and the others pick up its state.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        source: Callable,
+        interval: float = REPLICA_SYNC_INTERVAL,
+        product_refresh: float = REPLICA_PRODUCT_REFRESH,
+        column: str = CHANGE_WATERMARK_COLUMN,
+        check_interval: float = 10,
+    ):
+        self.source = source
+        self.interval = interval
+        self.product_refresh = product_refresh
+        self.column = column
+        self.check_interval = check_interval
+
+        self.engine = create_engine(url, connect_args={"check_same_thread": False} if url.startswith("sqlite") else {})
+        prefix = f"{DB}.{SCHEMA}."
+
+        if self.engine.dialect.name == "sqlite":
+            # pysqlite only opens a transaction before DML, a table being
+            # replaced would be seen empty without an explicit BEGIN. WAL
+            # lets the workers keep reading while a sync writes
+            @event.listens_for(self.engine, "connect")
+            def on_connect(dbapi_connection, connection_record):
+                dbapi_connection.isolation_level = None
+                dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+            @event.listens_for(self.engine, "begin")
+            def on_begin(conn):
+                conn.exec_driver_sql("BEGIN")
+
+        # the helpers' statements name the Snowflake schema, the copies live in the default one
+        @event.listens_for(self.engine, "before_cursor_execute", retval=True)
+        def strip_prefix(conn, cursor, statement, parameters, context, executemany):
+            return statement.replace(prefix, ""), parameters
+
+        database = self.engine.url.database
+        self.lock_path = f"{database}.lock" if database and database != ":memory:" else None
+
+        self.state: Dict[str, dict] = {}
+        self.syncs = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS replica_state (table_name VARCHAR, watermark VARCHAR, synced_at VARCHAR)"
+            ))
+        self.reload()
+
+    def ready(self) -> bool:
+        return all(table in self.state for table in REPLICA_TABLES)
+
+    def engine_or(self, fallback: Callable) -> Callable:
+        """An sf_engine for the helpers: the replica once it is ready, fallback until then."""
+        return lambda: self.engine if self.ready() else fallback()
+
+    def freshness(self, tables: Iterable[str] = REPLICA_TABLES) -> Optional[str]:
+        """
+        When the oldest of tables was last read from Snowflake, the copies
+        hold every change made before it
+        """
+        synced = [self.state[table]["synced_at"] for table in tables if table in self.state]
+        return min(synced) if synced else None
+
+    def reload(self) -> None:
+        with self.engine.connect() as conn:
+            rows = conn.execute(text("SELECT table_name, watermark, synced_at FROM replica_state")).fetchall()
+        self.state = {table: {"watermark": watermark, "synced_at": synced_at} for table, watermark, synced_at in rows}
+
+    def sync(self) -> int:
+        """Bring every due table up to date, returns the number of rows copied."""
+        copied = 0
+        for table in REPLICA_TABLES:
+            state = self.state.get(table)
+            if state is None or (state["watermark"] is None and self._age(table) >= self.product_refresh):
+                copied += self._copy_table(table)
+        copied += self._copy_changes()
+        self.syncs += 1
+        return copied
+
+    def _copy_table(self, table: str) -> int:
+        started = _now()
+        full_table = f"{DB}.{SCHEMA}.{table}"
+        with self.source().connect() as source:
+            watermark = None
+            if table in WATCHED_TABLES:
+                watermark = source.execute(text(f"SELECT MAX({self.column}) FROM {full_table}")).scalar()
+
+            result = source.execution_options(stream_results=True, yield_per=10000).execute(text(f"SELECT * FROM {full_table}"))
+            columns = [column.lower() for column in result.keys()]
+            insert = _insert(table, columns)
+            count = 0
+            with self.engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+                conn.execute(text(f"CREATE TABLE {table} ({', '.join(columns)})"))
+                for page in result.partitions(10000):
+                    conn.execute(insert, [dict(zip(columns, map(_local_value, row))) for row in page])
+                    count += len(page)
+                # the watermark column is indexed too, change detection polls the copies
+                for column in REPLICA_TABLES[table] + ((self.column,) if table in WATCHED_TABLES else ()):
+                    conn.execute(text(f"CREATE INDEX {table}_{column} ON {table} ({column})"))
+                self._save_state(conn, table, watermark, started)
+
+        logger.info(f"Copied {count} rows of {table} to the replica")
+        return count
+
+    def _copy_changes(self) -> int:
+        """
+        Copy again every row of the orders changed in any watched table, so
+        rows removed from a changed order upstream are removed here too
+        """
+        started = _now()
+        watermarks = {table: self.state[table]["watermark"] for table in WATCHED_TABLES}
+        numbers = set()
+        count = 0
+        with self.source().connect() as source:
+            for table, watermark in list(watermarks.items()):
+                if watermark is None:
+                    continue
+                rows = source.execute(text(f"""
+                    SELECT postsplitordernumber, MAX({self.column})
+                    FROM {DB}.{SCHEMA}.{table}
+                    WHERE {self.column} > :watermark
+                    GROUP BY postsplitordernumber
+                """), {"watermark": watermark}).fetchall()
+                if rows:
+                    watermarks[table] = max(row[1] for row in rows)
+                numbers |= {int(row[0]) for row in rows}
+
+            numbers = sorted(numbers)
+            with self.engine.begin() as conn:
+                for table in WATCHED_TABLES:
+                    for start in range(0, len(numbers), REPLICA_CHUNK_SIZE):
+                        chunk = numbers[start:start + REPLICA_CHUNK_SIZE]
+                        placeholders = ", ".join(f":n{i}" for i in range(len(chunk)))
+                        params = {f"n{i}": number for i, number in enumerate(chunk)}
+                        result = source.execute(
+                            text(f"SELECT * FROM {DB}.{SCHEMA}.{table} WHERE postsplitordernumber IN ({placeholders})"), params
+                        )
+                        columns = [column.lower() for column in result.keys()]
+                        copies = [dict(zip(columns, map(_local_value, row))) for row in result]
+                        conn.execute(text(f"DELETE FROM {table} WHERE postsplitordernumber IN ({placeholders})"), params)
+                        if copies:
+                            conn.execute(_insert(table, columns), copies)
+                        count += len(copies)
+                    self._save_state(conn, table, watermarks[table], started)
+
+        if numbers:
+            logger.info(f"Copied {count} rows of {len(numbers)} changed orders to the replica")
+        return count
+
+    def _save_state(self, conn, table: str, watermark, synced_at: str) -> None:
+        if watermark is not None:
+            watermark = str(_local_value(watermark))
+        conn.execute(text("DELETE FROM replica_state WHERE table_name = :table"), {"table": table})
+        conn.execute(
+            text("INSERT INTO replica_state VALUES (:table, :watermark, :synced_at)"),
+            {"table": table, "watermark": watermark, "synced_at": synced_at}
+        )
+        self.state[table] = {"watermark": watermark, "synced_at": synced_at}
+
+    def _age(self, table: str) -> float:
+        state = self.state.get(table)
+        if state is None:
+            return float("inf")
+        return (datetime.now(timezone.utc) - datetime.fromisoformat(state["synced_at"])).total_seconds()
+
+    def _due(self) -> bool:
+        return not self.ready() or max(self._age(table) for table in WATCHED_TABLES) >= self.interval
+
+    def refresh(self) -> None:
+        """Sync if the last sync is older than interval and pick up the latest state."""
+        self.reload()
+        if not self._due():
+            return
+        if self.lock_path is None:
+            self.sync()
+            return
+
+        with open(self.lock_path, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker is syncing
+            # it may have been synced while we waited
+            self.reload()
+            if self._due():
+                self.sync()
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready(),
+            "freshness": self.freshness(),
+            "tables": {table: dict(state) for table, state in self.state.items()},
+            "syncs": self.syncs,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="replica-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                logger.error(f"Replica sync failed: {e}")
+            if self._stop.wait(self.check_interval):
+                return
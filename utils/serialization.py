@@ -0,0 +1,32 @@
+import hashlib
+from typing import List, Optional
+
+from pydantic import TypeAdapter
+
+from utils.custom_types import OrderNumber, Product
+
+# the adapters serialise straight to bytes in pydantic-core, without
+# building dicts first or validating the models again
+order_list_adapter = TypeAdapter(List[OrderNumber])
+product_list_adapter = TypeAdapter(List[Product])
+
+def dump_orders(orders: List[OrderNumber]) -> bytes:
+    """Serialise a list of order trees to JSON bytes."""
+    return order_list_adapter.dump_json(orders)
+
+def dump_products(products: List[Product]) -> bytes:
+    """Serialise a list of products to JSON bytes."""
+    return product_list_adapter.dump_json(products)
+
+def content_etag(data: bytes) -> str:
+    """A strong ETag for a response body."""
+    return '"%s"' % hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header names etag, weak validators compare equal."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (candidate.strip() for candidate in if_none_match.split(","))
+    return etag in (candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates)
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict
+
+from utils.metrics import Counter, registry
+
+singleflight_calls_total = registry.register(Counter(
+    "wismo_singleflight_calls_total", "Single flight calls by whether they ran, joined one in flight or raised",
+    ("flight", "result")
+))
+
+
+class _Call:
+    """A fetch in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls for the same key. The first caller runs
+    the function while every caller arriving before it finishes waits and
+    shares its result. Errors are raised to all of them but nothing is
+    kept afterwards, so the next call tries again. name labels its
+    counts in wismo_singleflight_calls_total.
+    """
+
+    def __init__(self, name: str = "default"):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls: Dict[str, _Call] = {}
+        self.executed = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self.calls[key] = call
+                self.executed += 1
+                leader = True
+        singleflight_calls_total.inc(flight=self.name, result="executed" if leader else "coalesced")
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            with self.lock:
+                self.errors += 1
+            singleflight_calls_total.inc(flight=self.name, result="error")
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "in_flight": len(self.calls),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+            }
+
+
+class AsyncSingleFlight:
+    """
+    asyncio version of SingleFlight, callers for a key in flight await the
+    same task instead of starting their own.
+    """
+
+    def __init__(self, name: str = "default"):
+        self.name = name
+        self.calls: Dict[str, asyncio.Future] = {}
+        self.executed = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            singleflight_calls_total.inc(flight=self.name, result="coalesced")
+            # shield so a cancelled follower doesn't cancel the shared fetch
+            return await asyncio.shield(future)
+
+        self.executed += 1
+        singleflight_calls_total.inc(flight=self.name, result="executed")
+        future = asyncio.ensure_future(fn())
+        self.calls[key] = future
+        try:
+            return await asyncio.shield(future)
+        except BaseException:
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                self.errors += 1
+                singleflight_calls_total.inc(flight=self.name, result="error")
+            raise
+        finally:
+            if future.done():
+                self.calls.pop(key, None)
+            else:
+                # the leader was cancelled, drop the key once the fetch ends
+                future.add_done_callback(lambda _: self.calls.pop(key, None))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self.calls),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }